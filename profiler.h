@@ -6,9 +6,16 @@
 #ifndef PROFILER_H
 #define PROFILER_H
 
+#include <algorithm>
+#include <atomic>
 #include <chrono>
+#include <condition_variable>
+#include <cstdint>
 #include <deque>
+#include <mutex>
 #include <string>
+#include <thread>
+#include <unordered_map>
 #include <vector>
 #include <fstream>
 #include <unistd.h>
@@ -17,69 +24,220 @@
 namespace profiler {
 
   using TimeType = unsigned long long;
+  using StringId = std::uint32_t;
+
+  // text: one csv line per task (see README.md).
+  // binary: header followed by fixed size BinaryTaskRecord's. The task and group names are stored
+  //         in the file <filename>.strings (one string per line, the line number is the StringId).
+  //         (see scripts/task_bin.py)
+  enum class OutputFormat { text, binary };
+
+  constexpr char binary_magic[8] = {'P', 'R', 'O', 'F', 'B', 'I', 'N', '1'};
+
+  struct BinaryTaskRecord {
+    std::uint64_t time_start;
+    std::uint64_t time_end;
+    StringId task_name_id;
+    StringId task_group_name_id;
+    std::int32_t thread_id_start;
+    std::int32_t thread_id_end;
+  };
+  static_assert(sizeof(BinaryTaskRecord) == 32, "BinaryTaskRecord must not contain padding");
 
   class TaskProfileData {
     public:
-    TaskProfileData(const std::string& task_name, const std::string& task_group_name,
-                    int thread_id_start, TimeType time_start, int thread_id_end, TimeType time_end)
-     : task_name_(task_name), task_group_name_(task_group_name), thread_id_start_(thread_id_start),
-       time_start_(time_start), thread_id_end_(thread_id_end), time_end_(time_end) {}
+    TaskProfileData(StringId task_name_id, StringId task_group_name_id, int thread_id_start,
+                    TimeType time_start, int thread_id_end, TimeType time_end)
+     : task_name_id_(task_name_id), task_group_name_id_(task_group_name_id),
+       thread_id_start_(thread_id_start), time_start_(time_start), thread_id_end_(thread_id_end),
+       time_end_(time_end) {}
 
     template <class Out>
-    void write(Out& out_stream) {
-      out_stream << task_name_ << ", ";
-      out_stream << task_group_name_ << ", ";
+    void write(Out& out_stream, const std::vector<std::string>& strings) {
+      out_stream << strings[task_name_id_] << ", ";
+      out_stream << strings[task_group_name_id_] << ", ";
       out_stream << thread_id_start_ << ", ";
       out_stream << time_start_ << ", ";
       out_stream << thread_id_end_ << ", ";
-      out_stream << time_end_ << std::endl;
+      out_stream << time_end_ << "\n";
+    }
+
+    // string_ids maps the thread local StringId's to the ids of the output string table.
+    BinaryTaskRecord record(const std::vector<StringId>& string_ids) {
+      return {time_start_, time_end_, string_ids[task_name_id_], string_ids[task_group_name_id_],
+              thread_id_start_, thread_id_end_};
     }
 
     private:
-    std::string task_name_;
-    std::string task_group_name_;
+    StringId task_name_id_;
+    StringId task_group_name_id_;
     int thread_id_start_;
     TimeType time_start_;
     int thread_id_end_;
     TimeType time_end_;
   };
 
+  // The task and group names are interned per thread.
+  // The mutex is only contended while the flushing thread moves the buffered tasks out (see drain).
   class ThreadProfiler {
     public:
     void add(const std::string& task_name, const std::string& task_group_name, int thread_id_start,
              TimeType time_start, int thread_id_end, TimeType time_end) {
-      task_profiles.emplace_back(task_name, task_group_name, thread_id_start, time_start,
+      std::lock_guard<std::mutex> lock(mutex_);
+      StringId task_name_id = getStringId(task_name);
+      StringId task_group_name_id = getStringId(task_group_name);
+      task_profiles.emplace_back(task_name_id, task_group_name_id, thread_id_start, time_start,
                                  thread_id_end, time_end);
     }
 
+    // Writes the tasks buffered since the last write and returns their number.
     template <class Out>
-    void write(Out& out_stream) {
-      for (auto& task_profile : task_profiles)
-        task_profile.write(out_stream);
+    std::size_t write(Out& out_stream) {
+      std::deque<TaskProfileData> tasks;
+      drain(tasks);
+      for (auto& task_profile : tasks)
+        task_profile.write(out_stream, written_strings_);
+      return tasks.size();
+    }
+
+    // Appends the strings interned since the last write to the global string table
+    // (strings_stream, string_ids), writes the buffered tasks as BinaryTaskRecord's
+    // and returns their number.
+    template <class Out, class OutStrings>
+    std::size_t writeBinary(Out& out_stream, OutStrings& strings_stream,
+                            std::unordered_map<std::string, StringId>& string_ids) {
+      std::deque<TaskProfileData> tasks;
+      std::size_t n_strings = written_strings_.size();
+      drain(tasks);
+      bool new_strings = false;
+      for (std::size_t i = n_strings; i < written_strings_.size(); ++i) {
+        auto it = string_ids.find(written_strings_[i]);
+        if (it == string_ids.end()) {
+          it = string_ids.emplace(written_strings_[i], string_ids.size()).first;
+          strings_stream << written_strings_[i] << "\n";
+          new_strings = true;
+        }
+        global_ids_.push_back(it->second);
+      }
+      // A reader following the output needs the strings before the records referencing them.
+      if (new_strings)
+        strings_stream.flush();
+      for (auto& task_profile : tasks) {
+        BinaryTaskRecord record = task_profile.record(global_ids_);
+        out_stream.write(reinterpret_cast<const char*>(&record), sizeof(record));
+      }
+      return tasks.size();
     }
 
     private:
+    // Moves the buffered tasks to tasks and copies the strings interned since the last call,
+    // the worker thread is blocked only for the swap.
+    void drain(std::deque<TaskProfileData>& tasks) {
+      std::lock_guard<std::mutex> lock(mutex_);
+      std::swap(tasks, task_profiles);
+      written_strings_.insert(written_strings_.end(), strings_.begin() + written_strings_.size(),
+                              strings_.end());
+    }
+
+    // Looked up before inserting, since emplace allocates the node (and copies the string) in any case.
+    StringId getStringId(const std::string& string) {
+      auto it = string_ids_.find(string);
+      if (it != string_ids_.end())
+        return it->second;
+      StringId id = strings_.size();
+      string_ids_.emplace(string, id);
+      strings_.push_back(string);
+      return id;
+    }
+
+    std::mutex mutex_;
     std::deque<TaskProfileData> task_profiles;
+    std::vector<std::string> strings_;
+    std::unordered_map<std::string, StringId> string_ids_;
+
+    // Accessed only by the thread writing the output.
+    std::vector<std::string> written_strings_;
+    std::vector<StringId> global_ids_;
   };
 
+  // By default the tasks are kept in memory and written when the profiler is destroyed.
+  // With a flush policy (setFlushPolicy) a background thread appends the buffered tasks to the
+  // output file when the number of buffered tasks or their size exceeds a threshold or periodically.
   // TODO: Fix interface
   class Profiler {
     public:
-    Profiler() : filename_("profile_" + std::to_string(getpid()) + ".txt"), profilers_(257) {}
+    Profiler()
+     : filename_("profile_" + std::to_string(getpid()) + ".txt"), format_(OutputFormat::text),
+       profilers_(257), buffered_(0), flush_threshold_(0), flush_interval_(0),
+       flush_requested_(false), stop_(false) {}
     ~Profiler() {
-      std::ofstream fout(filename_);
-      for (auto& profiler : profilers_)
-        profiler.write(fout);
+      if (flusher_.joinable()) {
+        {
+          std::lock_guard<std::mutex> lock(flush_mutex_);
+          stop_ = true;
+        }
+        flush_cv_.notify_one();
+        flusher_.join();
+      }
+      flush();
     }
 
+    // The output options have to be set before the first task is recorded.
     void setOutputFilename(std::string output_name) {
       filename_ = output_name;
     }
 
+    void setOutputFormat(OutputFormat format) {
+      format_ = format;
+    }
+
+    // Flushes the buffered tasks when there are more than max_records tasks, when they use more than
+    // max_bytes bytes of memory, or every interval. A zero value disables the corresponding criterion.
+    void setFlushPolicy(std::size_t max_records, std::size_t max_bytes = 0,
+                        std::chrono::milliseconds interval = std::chrono::milliseconds(0)) {
+      std::size_t threshold = max_records;
+      if (max_bytes != 0) {
+        std::size_t max_bytes_records = std::max<std::size_t>(1, max_bytes / sizeof(TaskProfileData));
+        threshold = threshold == 0 ? max_bytes_records : std::min(threshold, max_bytes_records);
+      }
+      {
+        std::lock_guard<std::mutex> lock(flush_mutex_);
+        flush_threshold_ = threshold;
+        flush_interval_ = interval;
+      }
+      if ((threshold != 0 || interval.count() != 0) && !flusher_.joinable())
+        flusher_ = std::thread([this]() { flushLoop(); });
+      flush_cv_.notify_one();
+    }
+
     void add(const std::string& task_name, const std::string& task_group_name, int thread_id_start,
              TimeType time_start, int thread_id_end, TimeType time_end) {
+      // Counted before being buffered, since the flushing thread may write the task (and subtract it)
+      // as soon as it is added.
+      std::size_t buffered = ++buffered_;
       profilers_[thread_id_end + 1].add(task_name, task_group_name, thread_id_start, time_start,
                                         thread_id_end, time_end);
+      std::size_t threshold = flush_threshold_;
+      if (threshold != 0 && buffered >= threshold && !flush_requested_.exchange(true)) {
+        std::lock_guard<std::mutex> lock(flush_mutex_);
+        flush_cv_.notify_one();
+      }
+    }
+
+    // Appends the buffered tasks to the output file.
+    void flush() {
+      std::lock_guard<std::mutex> lock(write_mutex_);
+      if (!fout_.is_open())
+        openOutput();
+      std::size_t n = 0;
+      for (auto& profiler : profilers_) {
+        if (format_ == OutputFormat::binary)
+          n += profiler.writeBinary(fout_, fstrings_, string_ids_);
+        else
+          n += profiler.write(fout_);
+      }
+      fout_.flush();
+      buffered_ -= n;
     }
 
     TimeType getTime() {
@@ -94,8 +252,53 @@ namespace profiler {
     }
 
     private:
+    void openOutput() {
+      if (format_ == OutputFormat::binary) {
+        fout_.open(filename_, std::ios::binary);
+        std::uint32_t header[2] = {1, sizeof(BinaryTaskRecord)};  // version, record size
+        fout_.write(binary_magic, sizeof(binary_magic));
+        fout_.write(reinterpret_cast<const char*>(header), sizeof(header));
+        fstrings_.open(filename_ + ".strings");
+      }
+      else {
+        fout_.open(filename_);
+      }
+    }
+
+    void flushLoop() {
+      std::unique_lock<std::mutex> lock(flush_mutex_);
+      while (!stop_) {
+        auto wake_up = [this]() { return stop_ || flush_requested_; };
+        if (flush_interval_.count() != 0)
+          flush_cv_.wait_for(lock, flush_interval_, wake_up);
+        else
+          flush_cv_.wait(lock, wake_up);
+        if (stop_)
+          break;
+        flush_requested_ = false;
+        lock.unlock();
+        flush();
+        lock.lock();
+      }
+    }
+
     std::string filename_;
+    OutputFormat format_;
     std::vector<ThreadProfiler> profilers_;
+
+    std::mutex write_mutex_;
+    std::ofstream fout_;
+    std::ofstream fstrings_;
+    std::unordered_map<std::string, StringId> string_ids_;
+
+    std::atomic<std::size_t> buffered_;
+    std::atomic<std::size_t> flush_threshold_;
+    std::chrono::milliseconds flush_interval_;
+    std::atomic<bool> flush_requested_;
+    bool stop_;
+    std::mutex flush_mutex_;
+    std::condition_variable flush_cv_;
+    std::thread flusher_;
   };
 
   class GenericTaskProfiler {
@@ -0,0 +1,314 @@
+# Copyright (c) 2017, Raffaele Solcà
+# All rights reserved.
+#
+# See LICENSE.txt for terms of usage.
+
+import csv
+import json
+import argparse
+import numpy as np
+import task_bin
+import nvprof_reader
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+# The traces are loaded as dictionaries of numpy arrays:
+#   'name', 'group': indices in the arrays 'names', 'groups',
+#   'rank', 'thread_start', 'start', 'thread_end', 'end'.
+
+BLOCK_SIZE = 64 * 1024 * 1024
+
+# Yields blocks of complete lines of a csv profile.
+def read_blocks(filename, block_size=BLOCK_SIZE):
+  rest = b''
+  with open(filename, 'rb') as csvfile:
+    while True:
+      data = csvfile.read(block_size)
+      if len(data) == 0:
+        break
+      data = rest + data
+      end = data.rfind(b'\n') + 1
+      rest = data[end:]
+      if end > 0:
+        yield data[:end]
+  if len(rest.strip()) > 0:
+    yield rest + b'\n'
+
+# Maximum size of the fixed width string arrays used to encode the task names and groups.
+STRINGS_BUFFER_SIZE = 64 * 1024 * 1024
+
+# Encodes the fields [start, end) of buf (stripped) as (sorted unique strings, codes).
+# The fields are copied in fixed width bytes arrays (of bounded size) which are encoded by unique_strings.
+def encode_fields(buf, start, end):
+  for step in [1, -1]:
+    while True:
+      edge = start if step == 1 else end - 1
+      space = (start < end) & (buf[np.clip(edge, 0, len(buf) - 1)] <= 32)
+      if not space.any():
+        break
+      if step == 1:
+        start = start + space
+      else:
+        end = end - space
+  lengths = end - start
+  width = (max(1, int(lengths.max(initial=0))) + 7) // 8 * 8
+  rows = max(1, STRINGS_BUFFER_SIZE // width)
+  uniques, codes = [], []
+  for first in range(0, len(start), rows):
+    chars = buf.take(start[first:first + rows, None].astype(np.int32) + np.arange(width, dtype=np.int32), mode='clip')
+    chars[np.arange(width) >= lengths[first:first + rows, None]] = 0
+    slice_uniques, slice_codes = unique_strings(chars)
+    uniques.append(slice_uniques)
+    codes.append(slice_codes)
+  return merge_strings(uniques, codes)
+
+# np.unique(strings, return_inverse=True) of the rows of chars (null padded, width multiple of 8).
+# The rows are first deduplicated by a hash of their 8 bytes words, which is much faster than sorting
+# the strings, then only the unique strings are sorted.
+def unique_strings(chars):
+  strings = chars.view('S{}'.format(chars.shape[1])).ravel()
+  words = chars.view('>u8')
+  hashes = words[:, 0].copy()
+  for i in range(1, words.shape[1]):
+    hashes = hashes * np.uint64(0x9E3779B97F4A7C15) + words[:, i]
+  order = np.argsort(hashes)
+  sorted_hashes = hashes[order]
+  new_hash = np.concatenate(([True], sorted_hashes[1:] != sorted_hashes[:-1]))
+  first = order[new_hash]
+  codes = np.empty(len(hashes), dtype=np.int64)
+  codes[order] = np.cumsum(new_hash) - 1
+  if not (words == words[first[codes]]).all():
+    # Hash collision.
+    return np.unique(strings, return_inverse=True)
+  order = np.argsort(strings[first])
+  rank = np.empty(len(order), dtype=np.int64)
+  rank[order] = np.arange(len(order))
+  return strings[first][order], rank[codes]
+
+# Merges the (unique strings, codes) encodings of several blocks in a single one.
+def merge_strings(uniques, codes):
+  if len(uniques) == 1:
+    return uniques[0], codes[0]
+  strings, remap = np.unique(np.concatenate(uniques), return_inverse=True)
+  offsets = np.cumsum([0] + [len(block_uniques) for block_uniques in uniques])
+  return strings, np.concatenate([remap[offset + block_codes] for offset, block_codes in zip(offsets, codes)])
+
+# Splits a block of csv lines in the encoded task names, the encoded task groups (see encode_fields)
+# and the (n, 4) array of the thread ids and timestamps.
+# The fields are located and converted by numpy on the bytes of the block, without loops over the lines.
+def split_block(data):
+  buf = np.frombuffer(data, dtype=np.uint8)
+  newlines = np.flatnonzero(buf == ord('\n'))
+  commas = np.flatnonzero(buf == ord(','))
+  n_lines = len(newlines)
+  line_starts = np.concatenate(([0], newlines[:-1] + 1))
+  if len(commas) != 5 * n_lines or (n_lines > 0 and not ((commas[0::5] >= line_starts) & (commas[4::5] < newlines)).all()):
+    # Quoted fields or empty lines: let the csv module split them.
+    return split_quoted_block(data)
+  commas = commas.reshape(n_lines, 5)
+  names = encode_fields(buf, line_starts, commas[:, 0])
+  groups = encode_fields(buf, commas[:, 0] + 1, commas[:, 1])
+  # The numbers of each line are the bytes from its second comma to the newline (excluded), which joined
+  # give the comma separated list ",a,b,c,d,a,b,c,d...". The mask of these ranges is built by np.repeat.
+  lengths = np.empty(2 * n_lines, dtype=np.int64)
+  lengths[0::2] = commas[:, 1] - np.concatenate(([0], newlines[:-1]))
+  lengths[1::2] = newlines - commas[:, 1]
+  mask = np.repeat(np.tile([False, True], n_lines), lengths)
+  numbers = np.fromstring(buf[:len(mask)][mask][1:].tobytes(), dtype=np.int64, sep=',')
+  if len(numbers) != 4 * n_lines:
+    raise ValueError('Invalid csv profile: each line must contain 6 fields')
+  return names, groups, numbers.reshape(n_lines, 4)
+
+def split_quoted_block(data):
+  tasks = [task for task in csv.reader(data.decode().splitlines()) if len(task) > 0]
+  if any(len(task) != 6 for task in tasks):
+    raise ValueError('Invalid csv profile: each line must contain 6 fields')
+  encoded = []
+  for column in [0, 1]:
+    strings = np.array([task[column].strip().encode() for task in tasks], dtype=bytes)
+    encoded.append(np.unique(strings, return_inverse=True) if len(tasks) > 0 else (strings, np.zeros(0, dtype=np.int64)))
+  numbers = np.array([[int(field) for field in task[2:]] for task in tasks], dtype=np.int64).reshape(len(tasks), 4)
+  return encoded[0], encoded[1], numbers
+
+# Returns the strings of the encoded blocks (sorted) and the codes of all the tasks.
+def decode_strings(encoded):
+  strings, codes = merge_strings([uniques for uniques, _ in encoded], [block_codes for _, block_codes in encoded])
+  return np.char.decode(strings, 'utf-8').astype(str), codes
+
+def load_csv(filename, rank=0):
+  names, groups, numbers = [], [], []
+  for data in read_blocks(filename):
+    block_names, block_groups, block_numbers = split_block(data)
+    names.append(block_names)
+    groups.append(block_groups)
+    numbers.append(block_numbers)
+  if len(numbers) == 0:
+    return empty_trace()
+  trace = {}
+  trace['names'], trace['name'] = decode_strings(names)
+  trace['groups'], trace['group'] = decode_strings(groups)
+  numbers = np.concatenate(numbers)
+  for i, column in enumerate(['thread_start', 'start', 'thread_end', 'end']):
+    trace[column] = numbers[:, i].copy()
+  trace['rank'] = np.full(len(trace['start']), rank, dtype=np.int64)
+  return trace
+
+def load_binary(filename, rank=0):
+  records, strings = task_bin.load(filename)
+  strings = np.array(strings, dtype=str)
+  names, name = np.unique(records['task_name_id'], return_inverse=True)
+  groups, group = np.unique(records['task_group_id'], return_inverse=True)
+  return {'names': strings[names], 'name': name, 'groups': strings[groups], 'group': group,
+          'rank': np.full(len(records), rank, dtype=np.int64),
+          'thread_start': records['thread_id_start'].astype(np.int64), 'start': records['time_start'].astype(np.int64),
+          'thread_end': records['thread_id_end'].astype(np.int64), 'end': records['time_end'].astype(np.int64)}
+
+def load_nvprof(filename, begin=None, end=None):
+  reader = nvprof_reader.nvprof_reader(filename)
+  columns = reader.to_numpy(begin, end)
+  strings = reader.strings()
+  trace = {column: columns[column] for column in ['rank', 'thread_start', 'start', 'thread_end', 'end']}
+  for column, strings_column in [('name', 'names'), ('group', 'groups')]:
+    ids, trace[column] = np.unique(columns[column], return_inverse=True)
+    trace[strings_column] = np.array([strings.get(str_id, '') for str_id in ids.tolist()], dtype=str)
+  reader.close()
+  return trace
+
+def empty_trace():
+  trace = {column: np.zeros(0, dtype=np.int64) for column in ['name', 'group', 'rank', 'thread_start', 'start', 'thread_end', 'end']}
+  trace['names'] = np.zeros(0, dtype=str)
+  trace['groups'] = np.zeros(0, dtype=str)
+  return trace
+
+def load(filename, rank=0):
+  with open(filename, 'rb') as trace_file:
+    magic = trace_file.read(len(SQLITE_MAGIC))
+  if magic == SQLITE_MAGIC:
+    return load_nvprof(filename)
+  if magic[:len(task_bin.MAGIC)] == task_bin.MAGIC:
+    return load_binary(filename, rank)
+  return load_csv(filename, rank)
+
+# Returns count, total, mean, p50 and p99 of the durations of the tasks grouped by codes (n_codes groups).
+# The percentiles are linearly interpolated (as numpy.percentile).
+def duration_statistics(codes, durations, n_codes):
+  # The durations are sorted by code with a single sort of code * scale + duration if it fits in int64.
+  scale = int(durations.max(initial=0)) - int(durations.min(initial=0)) + 1
+  if n_codes * scale < 2**62:
+    keys = np.sort(codes * scale + (durations - durations.min(initial=0)))
+    sorted_durations = keys % scale + durations.min(initial=0)
+  else:
+    sorted_durations = durations[np.lexsort((durations, codes))]
+  count = np.bincount(codes, minlength=n_codes)
+  first = np.cumsum(count) - count
+  total = np.bincount(codes, weights=durations, minlength=n_codes)
+  stats = {'count': count, 'total': total, 'mean': total / np.maximum(count, 1)}
+  for label, q in [('p50', .5), ('p99', .99)]:
+    position = q * np.maximum(count - 1, 0)
+    low = np.floor(position).astype(np.int64)
+    high = np.ceil(position).astype(np.int64)
+    values = np.zeros(n_codes)
+    valid = count > 0
+    low_values = sorted_durations[(first + low)[valid]]
+    high_values = sorted_durations[(first + high)[valid]]
+    values[valid] = low_values + (high_values - low_values) * (position - low)[valid]
+    stats[label] = values
+  return stats
+
+def task_statistics(trace):
+  durations = trace['end'] - trace['start']
+  return {'name': duration_statistics(trace['name'], durations, len(trace['names'])),
+          'group': duration_statistics(trace['group'], durations, len(trace['groups']))}
+
+# Merges the (possibly nested) intervals of a thread. The intervals must be sorted by start.
+def merge_intervals(starts, ends):
+  run_end = np.maximum.accumulate(ends)
+  first = np.flatnonzero(np.concatenate(([True], starts[1:] > run_end[:-1])))
+  return starts[first], np.maximum.reduceat(ends, first)
+
+# Busy time of the disjoint sorted intervals in each bin defined by edges.
+def busy_per_bin(starts, ends, edges):
+  busy_before = np.concatenate(([0], np.cumsum(ends - starts)))
+  k = np.searchsorted(starts, edges, side='right') - 1
+  busy = np.where(k >= 0, busy_before[np.maximum(k, 0)] + np.clip(edges - starts[np.maximum(k, 0)], 0, (ends - starts)[np.maximum(k, 0)]), 0)
+  return np.diff(busy)
+
+# Per thread (rank, thread where the tasks start) busy fractions in n_bins time bins over the whole trace,
+# and the n_gaps longest idle gaps between the tasks of the same thread.
+def thread_utilization(trace, n_bins=20, n_gaps=10):
+  if len(trace['start']) == 0:
+    return {'threads': [], 'edges': np.zeros(0, dtype=np.int64), 'busy': np.zeros((0, n_bins)), 'gaps': []}
+  # The times are relative to the beginning of the trace to keep the precision of the bin edges.
+  time_0 = trace['start'].min()
+  edges = np.linspace(0, trace['end'].max() - time_0, n_bins + 1)
+  order = np.lexsort((trace['start'], trace['thread_start'], trace['rank']))
+  rank = trace['rank'][order]
+  thread = trace['thread_start'][order]
+  starts = trace['start'][order] - time_0
+  ends = trace['end'][order] - time_0
+  boundaries = np.flatnonzero(np.concatenate(([True], (rank[1:] != rank[:-1]) | (thread[1:] != thread[:-1]), [True])))
+  threads = []
+  busy = np.zeros((len(boundaries) - 1, n_bins))
+  gaps = []
+  for i in range(len(boundaries) - 1):
+    begin, end = boundaries[i], boundaries[i + 1]
+    threads.append((int(rank[begin]), int(thread[begin])))
+    merged_starts, merged_ends = merge_intervals(starts[begin:end], ends[begin:end])
+    busy[i] = busy_per_bin(merged_starts, merged_ends, edges) / np.maximum(np.diff(edges), 1)
+    gap_lengths = merged_starts[1:] - merged_ends[:-1]
+    longest = np.argsort(gap_lengths)[::-1][:n_gaps]
+    gaps += [(int(gap_lengths[j]), threads[-1][0], threads[-1][1], int(time_0 + merged_ends[j]), int(time_0 + merged_starts[j + 1])) for j in longest]
+  gaps.sort(reverse=True)
+  return {'threads': threads, 'edges': time_0 + np.round(edges).astype(np.int64), 'busy': busy, 'gaps': gaps[:n_gaps]}
+
+def statistics_table(strings, stats, order_by='total', limit=None):
+  order = np.argsort(stats[order_by])[::-1]
+  order = order[stats['count'][order] > 0][:limit]
+  lines = ['{:>10} {:>14} {:>12} {:>12} {:>12}  {}'.format('count', 'total', 'mean', 'p50', 'p99', 'name')]
+  for i in order:
+    lines.append('{:>10} {:>14.1f} {:>12.3f} {:>12.3f} {:>12.3f}  {}'.format(
+        stats['count'][i], stats['total'][i] / 1e3, stats['mean'][i] / 1e3, stats['p50'][i] / 1e3, stats['p99'][i] / 1e3, strings[i]))
+  return '\n'.join(lines)
+
+def report(trace, stats, utilization, limit=None):
+  print('Tasks: {}  (times in microseconds)'.format(len(trace['start'])))
+  print('\nPer task name:')
+  print(statistics_table(trace['names'], stats['name'], limit=limit))
+  print('\nPer task group:')
+  print(statistics_table(trace['groups'], stats['group'], limit=limit))
+  print('\nThread busy fraction (%) per time bin:')
+  for (rank, thread), busy in zip(utilization['threads'], utilization['busy']):
+    print('rank {:>4} thread {:>4}: {:5.1f} |{}'.format(rank, thread, 100 * busy.mean(), ' '.join('{:3.0f}'.format(100 * b) for b in busy)))
+  print('\nLongest idle gaps:')
+  for length, rank, thread, gap_start, gap_end in utilization['gaps']:
+    print('rank {:>4} thread {:>4}: {:14.1f} us  [{}, {}]'.format(rank, thread, length / 1e3, gap_start, gap_end))
+
+def to_json(trace, stats, utilization):
+  result = {'tasks': len(trace['start'])}
+  for key, strings in [('name', 'names'), ('group', 'groups')]:
+    result[key] = {str(string): {label: stats[key][label][i].item() for label in stats[key]}
+                   for i, string in enumerate(trace[strings]) if stats[key]['count'][i] > 0}
+  result['bin_edges'] = utilization['edges'].tolist()
+  result['threads'] = [{'rank': rank, 'thread': thread, 'busy': busy.tolist()} for (rank, thread), busy in zip(utilization['threads'], utilization['busy'])]
+  result['idle_gaps'] = [{'length': length, 'rank': rank, 'thread': thread, 'start': gap_start, 'end': gap_end}
+                         for length, rank, thread, gap_start, gap_end in utilization['gaps']]
+  return result
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Task statistics, thread utilization and idle gaps of a csv, binary or nvprof profile')
+  parser.add_argument('filename', help='name of the csv, binary or nvprof profile')
+  parser.add_argument('--rank', '-r', type=int, default=0, help='MPI rank number of csv and binary profiles (default: 0)')
+  parser.add_argument('--bins', '-b', type=int, default=20, help='Number of time bins of the thread utilization (default: 20)')
+  parser.add_argument('--gaps', '-g', type=int, default=10, help='Number of idle gaps reported (default: 10)')
+  parser.add_argument('--limit', '-l', type=int, default=None, help='Maximum number of task names and groups reported (default: all)')
+  parser.add_argument('--json', '-j', help='Write the results in the given json file instead of printing them')
+  args = parser.parse_args()
+
+  trace = load(args.filename, args.rank)
+  stats = task_statistics(trace)
+  utilization = thread_utilization(trace, args.bins, args.gaps)
+  if args.json == None:
+    report(trace, stats, utilization, args.limit)
+  else:
+    with open(args.json, 'w') as json_file:
+      json.dump(to_json(trace, stats, utilization), json_file, indent=2)
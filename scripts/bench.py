@@ -0,0 +1,145 @@
+# Copyright (c) 2017, Raffaele Solcà
+# All rights reserved.
+#
+# See LICENSE.txt for terms of usage.
+
+# Benchmark of the import of synthetic profiles with prof.py.
+# For each thread mode (plain and --combine-threads) a new profile is created from the generated profiles
+# (new mode), then the appended tasks are added to it (append mode). The throughput, the peak resident set
+# size and the size of the profile are written in a json file to track regressions.
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import gen_trace
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Runs a command and returns its wall time in seconds and the peak resident set size in bytes
+# of the largest process (the command or one of its worker processes).
+def run(command):
+  start = time.perf_counter()
+  process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+  _, status, usage = os.wait4(process.pid, 0)
+  elapsed = time.perf_counter() - start
+  process.returncode = os.waitstatus_to_exitcode(status)
+  if process.returncode != 0:
+    raise subprocess.CalledProcessError(process.returncode, command)
+  # ru_maxrss is in bytes on macOS and in kilobytes on Linux.
+  peak_rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+  return elapsed, peak_rss
+
+# prof.py command importing the given profiles. A single profile is imported with the single file path,
+# multiple profiles through a rank map (the appended profiles have to be added to the same ranks).
+def import_command(filenames, output_filename, color_filename, combined, jobs, workdir):
+  command = [sys.executable, os.path.join(SCRIPT_DIR, 'prof.py'), '-o', output_filename, '-c', color_filename]
+  if combined:
+    command += ['-C', '1']
+  if jobs != None:
+    command += ['-j', str(jobs)]
+  if len(filenames) == 1:
+    return command + [filenames[0]]
+  rank_map = os.path.join(workdir, 'rank_map.json')
+  with open(rank_map, 'w') as map_file:
+    json.dump({rank: filename for rank, filename in enumerate(filenames)}, map_file)
+  return command + ['-m', rank_map]
+
+def git_revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=SCRIPT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def benchmark(args, workdir):
+  color_filename = os.path.join(workdir, 'task_color.json')
+  gen_trace.write_colors(color_filename, args.colors, args.names, args.groups, args.seed)
+
+  print('Generating {} ranks of {} + {} tasks in {}'.format(args.ranks, args.tasks, args.append_tasks, workdir))
+  profiles = []
+  for rank in range(args.ranks):
+    seed = None if args.seed == None else args.seed + rank
+    filename = gen_trace.profile_filename(os.path.join(workdir, 'profile'), rank, args.ranks)
+    gen_trace.write_profile(filename, args.tasks, args.threads, args.names, args.groups, args.migrate, seed=seed)
+    # The appended profile contains the tasks of the profile followed by the appended tasks.
+    appended_filename = gen_trace.profile_filename(os.path.join(workdir, 'appended'), rank, args.ranks)
+    shutil.copyfile(filename, appended_filename)
+    gen_trace.write_profile(appended_filename, args.append_tasks, args.threads, args.names, args.groups, args.migrate,
+                            append=True, seed=None if seed == None else seed + args.ranks)
+    imported_filename = gen_trace.profile_filename(os.path.join(workdir, 'import'), rank, args.ranks)
+    profiles.append((filename, appended_filename, imported_filename))
+  imported_filenames = [imported_filename for _, _, imported_filename in profiles]
+
+  output_filename = os.path.join(workdir, 'profile.nvprof')
+  results = []
+  for combined in [False, True]:
+    for repetition in range(args.repeat):
+      if os.path.exists(output_filename):
+        os.remove(output_filename)
+      # In append mode the imported files are replaced by the appended profiles, therefore the ingestion
+      # manifest makes prof.py import only the appended tasks in the existing nvprof profile.
+      for mode, n_tasks in [('new', args.tasks), ('append', args.append_tasks)]:
+        for filename, appended_filename, imported_filename in profiles:
+          shutil.copyfile(filename if mode == 'new' else appended_filename, imported_filename)
+        command = import_command(imported_filenames, output_filename, color_filename, combined, args.jobs, workdir)
+        elapsed, peak_rss = run(command)
+        result = {
+          'mode': mode,
+          'combine_threads': combined,
+          'repetition': repetition,
+          'tasks': n_tasks * args.ranks,
+          'seconds': elapsed,
+          'tasks_per_second': n_tasks * args.ranks / elapsed,
+          'peak_rss_bytes': peak_rss,
+          'nvprof_bytes': os.path.getsize(output_filename),
+        }
+        print('{:6} combine_threads={!s:5} {:10} tasks {:8.2f} s {:10.0f} tasks/s peak RSS {:8.1f} MiB profile {:8.1f} MiB'.format(
+            mode, combined, result['tasks'], elapsed, result['tasks_per_second'], peak_rss / 2**20, result['nvprof_bytes'] / 2**20))
+        results.append(result)
+  return results
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark of the import of synthetic profiles with prof.py')
+  parser.add_argument('--tasks', '-n', type=int, default=1000000, help='Number of tasks per rank of the new profile (default: 1000000)')
+  parser.add_argument('--append-tasks', type=int, default=None, help='Number of tasks per rank appended to the profile (default: TASKS / 10)')
+  parser.add_argument('--threads', '-t', type=int, default=8, help='Number of threads per rank (default: 8)')
+  parser.add_argument('--ranks', '-r', type=int, default=1, help='Number of ranks (default: 1)')
+  parser.add_argument('--names', type=int, default=100, help='Number of distinct task names (default: 100)')
+  parser.add_argument('--groups', type=int, default=10, help='Number of distinct task groups (default: 10)')
+  parser.add_argument('--colors', type=int, default=20, help='Number of entries of the color dictionary (default: 20)')
+  parser.add_argument('--migrate', type=float, default=0., help='Fraction of the tasks ending on another thread (default: 0)')
+  parser.add_argument('--jobs', '-j', type=int, default=None, help='Number of processes used by prof.py with multiple ranks (Default: number of cores)')
+  parser.add_argument('--repeat', type=int, default=1, help='Number of repetitions of each benchmark (default: 1)')
+  parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator (default: 0)')
+  parser.add_argument('--workdir', '-w', default=None, help='Directory where the profiles are generated (Default: a temporary directory, removed at the end)')
+  parser.add_argument('--output', '-o', default='bench_results.json', help='json file where the results are written (Default: bench_results.json)')
+  args = parser.parse_args()
+  if args.append_tasks == None:
+    args.append_tasks = max(1, args.tasks // 10)
+
+  if args.workdir == None:
+    workdir = tempfile.mkdtemp(prefix='prof_bench_')
+  else:
+    workdir = args.workdir
+    os.makedirs(workdir, exist_ok=True)
+  try:
+    results = benchmark(args, workdir)
+  finally:
+    if args.workdir == None:
+      shutil.rmtree(workdir)
+
+  with open(args.output, 'w') as json_file:
+    json.dump({
+      'parameters': vars(args),
+      'revision': git_revision(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'cpus': os.cpu_count(),
+      'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+      'results': results,
+    }, json_file, indent=2)
@@ -0,0 +1,138 @@
+# Copyright (c) 2017, Raffaele Solcà
+# All rights reserved.
+#
+# See LICENSE.txt for terms of usage.
+
+# Writer of profiles in the Chrome trace event format (json), which can be opened with chrome://tracing
+# and with the Perfetto UI. The events are written while the tasks are read, therefore the memory used
+# does not depend on the number of tasks.
+
+import json
+import nvprof_db
+
+# Reserved color names of the trace viewer and their RGB values.
+# The colors of task_color.json are mapped to the closest one.
+RESERVED_COLORS = {
+  'thread_state_running': (126, 200, 148),
+  'thread_state_runnable': (133, 160, 210),
+  'thread_state_iowait': (255, 140, 0),
+  'thread_state_uninterruptible': (182, 125, 143),
+  'background_memory_dump': (0, 180, 180),
+  'light_memory_dump': (0, 0, 180),
+  'detailed_memory_dump': (180, 0, 180),
+  'vsync_highlight_color': (0, 0, 255),
+  'generic_work': (125, 125, 125),
+  'good': (0, 125, 0),
+  'bad': (180, 125, 0),
+  'terrible': (180, 0, 0),
+  'black': (0, 0, 0),
+  'grey': (221, 221, 221),
+  'white': (255, 255, 255),
+  'yellow': (255, 255, 0),
+  'olive': (100, 100, 0),
+  'rail_response': (67, 135, 253),
+  'rail_animation': (244, 74, 63),
+  'rail_idle': (238, 142, 0),
+  'rail_load': (13, 168, 97),
+}
+
+def reserved_color(color):
+  rgb = [int(color[i:i + 2], 16) for i in (0, 2, 4)]
+  return min(RESERVED_COLORS, key=lambda name: sum((a - b) ** 2 for a, b in zip(RESERVED_COLORS[name], rgb)))
+
+# Formats a time in nanoseconds as microseconds, without loss of precision.
+def microseconds(time):
+  sign = '-' if time < 0 else ''
+  return '{}{}.{:03d}'.format(sign, abs(time) // 1000, abs(time) % 1000)
+
+class chrome_trace:
+
+  # The timestamps are written relative to time_origin (Default: the start of the first task rounded down
+  # to the second), since the viewers store them as double precision microseconds.
+  # With combined the tasks are written on a single thread per rank, with the start thread as category
+  # (as nvprof_db.insert_task with combined).
+  def __init__(self, filename, color_filename='', time_origin=None, combined=False):
+    self.out = open(filename, 'w')
+    self.out.write('{"traceEvents":[\n')
+    self.first_event = True
+    self.time_origin = time_origin
+    self.combined = combined
+    self.threads = set()
+    self.flow_id = 0
+    self.escaped = {}
+    self.colors = {}
+    self.task_colors, self.task_group_colors = nvprof_db.load_colors(color_filename)
+
+  def close(self):
+    other_data = {'time_origin_ns': self.time_origin}
+    self.out.write('\n],"displayTimeUnit":"ns","otherData":{}}}\n'.format(json.dumps(other_data)))
+    self.out.close()
+
+  def write_event(self, event):
+    if not self.first_event:
+      self.out.write(',\n')
+    self.first_event = False
+    self.out.write(event)
+
+  # json string of a task name or group. The cache is bounded, since the names may be unique per task.
+  def escape(self, string):
+    escaped = self.escaped.get(string)
+    if escaped is None:
+      if len(self.escaped) > 100000:
+        self.escaped = {}
+      escaped = json.dumps(string)
+      self.escaped[string] = escaped
+    return escaped
+
+  def color(self, task_name, task_group):
+    key = (task_name, task_group)
+    if key not in self.colors:
+      if len(self.colors) > 100000:
+        self.colors = {}
+      color = nvprof_db.match_color(self.task_colors, self.task_group_colors, task_name, task_group)
+      self.colors[key] = '' if color is None else ',"cname":"{}"'.format(reserved_color(color))
+    return self.colors[key]
+
+  def insert_process(self, rank_id):
+    self.write_event('{{"name":"process_name","ph":"M","pid":{},"args":{{"name":"Rank {}"}}}}'.format(rank_id, rank_id))
+
+  def insert_thread(self, rank_id, tid):
+    if (rank_id, tid) not in self.threads:
+      self.threads.add((rank_id, tid))
+      self.write_event('{{"name":"thread_name","ph":"M","pid":{},"tid":{},"args":{{"name":"Thread {}"}}}}'.format(rank_id, tid, tid))
+
+  # The tasks are written as complete events on the thread where they start.
+  # The tasks which end on another thread (e.g. HpxTaskProfiler) are linked to the end thread by a flow event
+  # (the async events would be displayed on process tracks instead of the threads).
+  def insert_task(self, rank_id, task_name, task_group, tid_st, time_st, tid_end, time_end):
+    if self.time_origin is None:
+      self.time_origin = time_st // 1000000000 * 1000000000
+    cname = self.color(task_name, task_group)
+    if self.combined and tid_st >= 0:
+      task_group = "Thread {}".format(tid_st)
+      tid_st = 0
+      tid_end = 0
+    self.insert_thread(rank_id, tid_st)
+    name = self.escape(task_name)
+    cat = self.escape(task_group)
+    ts = microseconds(time_st - self.time_origin)
+    dur = microseconds(time_end - time_st)
+    if tid_st == tid_end:
+      self.write_event('{{"name":{},"cat":{},"ph":"X","ts":{},"dur":{},"pid":{},"tid":{}{}}}'.format(
+          name, cat, ts, dur, rank_id, tid_st, cname))
+      return
+    self.insert_thread(rank_id, tid_end)
+    self.flow_id += 1
+    self.write_event('{{"name":{},"cat":{},"ph":"X","ts":{},"dur":{},"pid":{},"tid":{}{},"args":{{"end_thread":{}}}}}'.format(
+        name, cat, ts, dur, rank_id, tid_st, cname, tid_end))
+    self.write_event('{{"name":{},"cat":{},"ph":"s","id":{},"ts":{},"pid":{},"tid":{}}}'.format(
+        name, cat, self.flow_id, ts, rank_id, tid_st))
+    self.write_event('{{"name":{},"cat":{},"ph":"f","bp":"e","id":{},"ts":{},"pid":{},"tid":{}}}'.format(
+        name, cat, self.flow_id, microseconds(time_end - self.time_origin), rank_id, tid_end))
+
+  def insert_tasks(self, rank_id, tasks):
+    n_tasks = 0
+    for task_name, task_group, tid_st, time_st, tid_end, time_end in tasks:
+      self.insert_task(rank_id, task_name, task_group, tid_st, time_st, tid_end, time_end)
+      n_tasks += 1
+    return n_tasks
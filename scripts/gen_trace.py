@@ -0,0 +1,117 @@
+# Copyright (c) 2017, Raffaele Solcà
+# All rights reserved.
+#
+# See LICENSE.txt for terms of usage.
+
+# Generator of synthetic csv profiles (in the format written by the Profiler) and color dictionaries,
+# used to benchmark the import of large profiles. The tasks are generated and written in chunks,
+# therefore the memory used does not depend on the number of tasks.
+
+import os
+import json
+import argparse
+import numpy as np
+
+CHUNK_SIZE = 1000000
+
+def task_names(n_names, n_groups):
+  return ['Task {}, Group {}'.format(i, i % n_groups) for i in range(n_names)]
+
+# Returns the end timestamp of the last task of a csv profile (None if the file is empty or missing).
+def last_time(filename):
+  if not os.path.isfile(filename):
+    return None
+  with open(filename, 'rb') as csvfile:
+    csvfile.seek(max(0, os.path.getsize(filename) - 4096))
+    lines = csvfile.read().split(b'\n')
+  for line in reversed(lines):
+    fields = line.split(b',')
+    if len(fields) == 6:
+      return int(fields[5])
+  return None
+
+# Yields chunks of csv lines. The tasks are distributed round robin on the threads and each thread
+# executes its tasks one after the other, separated by idle gaps. The durations and the gaps are
+# exponentially distributed, and a fraction migrate of the tasks end on another thread (as HPX tasks).
+# clock contains the current time of each thread and is updated.
+def generate_lines(rng, clock, n_tasks, names, migrate=0., mean_duration=10000, mean_gap=1000, chunk_size=CHUNK_SIZE):
+  n_threads = len(clock)
+  names = np.array(names, dtype=object)
+  while n_tasks > 0:
+    n = min(n_tasks, chunk_size)
+    n_tasks -= n
+    rounds = (n + n_threads - 1) // n_threads
+    durations = rng.exponential(mean_duration, (rounds, n_threads)).astype(np.int64) + 1
+    gaps = rng.exponential(mean_gap, (rounds, n_threads)).astype(np.int64)
+    time_end = clock + np.cumsum(durations + gaps, axis=0)
+    time_st = time_end - durations
+    clock[:] = time_end[-1]
+
+    tid_st = np.tile(np.arange(n_threads), rounds)[:n]
+    tid_end = tid_st.copy()
+    if n_threads > 1 and migrate > 0:
+      migrated = rng.random(n) < migrate
+      tid_end[migrated] = (tid_st[migrated] + rng.integers(1, n_threads, np.count_nonzero(migrated))) % n_threads
+    task_name = names[rng.integers(0, len(names), n)]
+
+    yield ''.join(map('{}, {}, {}, {}, {}\n'.format, task_name, tid_st.tolist(), time_st.ravel()[:n].tolist(),
+                      tid_end.tolist(), time_end.ravel()[:n].tolist()))
+
+# Writes (or appends, continuing after the last task of the file) n_tasks tasks to a csv profile.
+def write_profile(filename, n_tasks, n_threads, n_names, n_groups, migrate=0., start_time=1500000000000000000,
+                  append=False, seed=None, chunk_size=CHUNK_SIZE):
+  rng = np.random.default_rng(seed)
+  if append:
+    end = last_time(filename)
+    if end != None:
+      start_time = end
+  clock = np.full(n_threads, start_time, dtype=np.int64)
+  names = task_names(n_names, n_groups)
+  with open(filename, 'a' if append else 'w') as csvfile:
+    for lines in generate_lines(rng, clock, n_tasks, names, migrate, chunk_size=chunk_size):
+      csvfile.write(lines)
+
+# Writes a color dictionary with n_colors entries: half task names and half task groups.
+# Only a part of the entries match the generated names, the others have to be checked for every task name.
+def write_colors(filename, n_colors, n_names, n_groups, seed=None):
+  rng = np.random.default_rng(seed)
+  n_task_colors = (n_colors + 1) // 2
+  task_colors = {}
+  for i in range(n_task_colors):
+    name = 'Task {}'.format(i * 2 + 1) if i % 2 == 0 else 'Unused task {}'.format(i)
+    task_colors[name] = '{:06X}'.format(int(rng.integers(0, 1 << 24)))
+  task_group_colors = {}
+  for i in range(n_colors - n_task_colors):
+    group = 'Group {}'.format(i) if i < n_groups else 'Unused group {}'.format(i)
+    task_group_colors[group] = '{:06X}'.format(int(rng.integers(0, 1 << 24)))
+  with open(filename, 'w') as json_file:
+    json.dump({'task_colors': task_colors, 'task_group_colors': task_group_colors}, json_file, indent=2)
+
+# Name of the profile of a rank: PREFIX.csv with a single rank, PREFIX_RANK.csv otherwise.
+def profile_filename(prefix, rank, n_ranks):
+  if n_ranks == 1:
+    return prefix + '.csv'
+  return '{}_{}.csv'.format(prefix, rank)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Generate synthetic csv profiles and a color dictionary')
+  parser.add_argument('prefix', help='prefix of the generated profiles: PREFIX.csv with a single rank, PREFIX_RANK.csv otherwise')
+  parser.add_argument('--tasks', '-n', type=int, default=1000000, help='Number of tasks per rank (default: 1000000)')
+  parser.add_argument('--threads', '-t', type=int, default=8, help='Number of threads per rank (default: 8)')
+  parser.add_argument('--ranks', '-r', type=int, default=1, help='Number of ranks (default: 1)')
+  parser.add_argument('--names', type=int, default=100, help='Number of distinct task names (default: 100)')
+  parser.add_argument('--groups', type=int, default=10, help='Number of distinct task groups (default: 10)')
+  parser.add_argument('--colors', type=int, default=0, help='Number of entries of the generated color dictionary (default: 0, no dictionary)')
+  parser.add_argument('--color-dict-filename', '-c', default='./task_color.json', help='Name of the generated color dictionary (Default: ./task_color.json)')
+  parser.add_argument('--migrate', type=float, default=0., help='Fraction of the tasks ending on another thread (default: 0)')
+  parser.add_argument('--append', action='store_true', help='Append the tasks to the existing profiles, after their last task')
+  parser.add_argument('--seed', type=int, default=None, help='Seed of the random generator (default: random)')
+  args = parser.parse_args()
+
+  for rank in range(args.ranks):
+    seed = None if args.seed == None else args.seed + rank
+    filename = profile_filename(args.prefix, rank, args.ranks)
+    print(filename)
+    write_profile(filename, args.tasks, args.threads, args.names, args.groups, args.migrate, append=args.append, seed=seed)
+  if args.colors > 0:
+    write_colors(args.color_dict_filename, args.colors, args.names, args.groups, args.seed)
@@ -8,39 +8,108 @@ import json
 import os
 import sqlite3
 
+MARKER_INDEX = 'CREATE INDEX INDEX_CUPTI_ACTIVITY_KIND_MARKER ON CUPTI_ACTIVITY_KIND_MARKER(timestamp)'
+EMPTY_PAYLOAD = sqlite3.Binary(b'\x00'*8)
+
 class nvprof_db:
 
   def __init__(self, filename, color_filename=''):
     if os.path.exists(filename):
       if os.path.isfile(filename):
         self.db = sqlite3.connect(filename)
-        dbc = self.db.cursor()
-        ids = dbc.execute('SELECT id FROM CUPTI_ACTIVITY_KIND_MARKER').fetchall()
-        if len(ids) == 0:
-            ids = [(0,)]
-        self.task_id = max(ids)[0] + 1
+        self.tune()
+        self.create_manifest()
+        self.task_id = self.max_task_id() + 1
       else:
         print("Database filename {} is a directory".format(filename))
         sys.exit(1)
     else:
       self.db = sqlite3.connect(filename)
+      self.tune()
       self.create_tables()
       self.task_id = 1
+    self.strings = None
+    self.colors = {}
     self.load_color_from_json(color_filename)
 
   def commit(self):
     self.db.commit()
 
+  def rollback(self):
+    self.db.rollback()
+
+  def tune(self):
+    # Everything is committed in a single transaction, fsync at every page write is not needed.
+    dbc = self.db.cursor()
+    dbc.execute('PRAGMA synchronous=OFF')
+    dbc.execute('PRAGMA temp_store=MEMORY')
+    dbc.execute('PRAGMA cache_size=-262144')
+
+  def load_strings(self):
+    if self.strings is None:
+      dbc = self.db.cursor()
+      self.strings = {value: str_id for str_id, value in dbc.execute('SELECT _id_, value FROM "StringTable"')}
+
   def insert_string(self, string):
+    self.load_strings()
+    str_id = self.strings.get(string)
+    if str_id is not None:
+      return str_id
     dbc = self.db.cursor()
-    rows = dbc.execute('SELECT _id_ FROM "StringTable" WHERE value=?', (string,)).fetchall()
-    if len(rows) > 0:
-      return rows[0][0]
     dbc.execute('INSERT INTO "StringTable" (value) VALUES' + "(?)", (string,));
+    self.strings[string] = dbc.lastrowid
+    return dbc.lastrowid
+
+  def max_task_id(self):
+    dbc = self.db.cursor()
+    task_id = dbc.execute('SELECT max(lastTaskId) FROM "IngestionManifest"').fetchone()[0]
+    if task_id is None:
+      task_id = dbc.execute('SELECT max(id) FROM "CUPTI_ACTIVITY_KIND_MARKER"').fetchone()[0]
+    if task_id is None:
+      task_id = 0
+    return task_id
+
+  # The manifest records which byte range [start, end) of each source profile has been imported
+  # for a given rank, the fingerprint of the source up to end, the task ids assigned, and the options
+  # which changed the imported tasks (filters, combined threads; empty for a plain import).
+  def create_manifest(self):
+    dbc = self.db.cursor()
+    dbc.execute('CREATE TABLE IF NOT EXISTS IngestionManifest(_id_ INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT NOT NULL, rank INT NOT NULL, start INT NOT NULL, end INT NOT NULL, fingerprint TEXT NOT NULL, firstTaskId INT NOT NULL, lastTaskId INT NOT NULL, options TEXT NOT NULL DEFAULT \'\')')
+    columns = [column[1] for column in dbc.execute('PRAGMA table_info("IngestionManifest")')]
+    if 'options' not in columns:
+      dbc.execute('ALTER TABLE "IngestionManifest" ADD COLUMN options TEXT NOT NULL DEFAULT \'\'')
+
+  # Returns (end, fingerprint, options) of the last import of source for rank id_rank, None if it was never imported.
+  def last_ingestion(self, source, id_rank):
+    dbc = self.db.cursor()
+    return dbc.execute('SELECT end, fingerprint, options FROM "IngestionManifest" WHERE source=? AND rank=? ORDER BY end DESC LIMIT 1', (source, id_rank)).fetchone()
+
+  # Records the import of [start, end) of source with the given options, whose tasks received the ids
+  # from first_task_id to the current task id. Returns the manifest entry id.
+  def record_ingestion(self, source, id_rank, start, end, fingerprint, first_task_id, options=''):
+    dbc = self.db.cursor()
+    dbc.execute('INSERT INTO "IngestionManifest" (source, rank, start, end, fingerprint, firstTaskId, lastTaskId, options) VALUES(?,?,?,?,?,?,?,?)', (source, id_rank, start, end, fingerprint, first_task_id, self.task_id - 1, options))
     return dbc.lastrowid
 
+  # Extends a manifest entry up to end (used when following a profile).
+  def update_ingestion(self, entry_id, end, fingerprint):
+    dbc = self.db.cursor()
+    dbc.execute('UPDATE "IngestionManifest" SET end=?, fingerprint=?, lastTaskId=? WHERE _id_=?', (end, fingerprint, self.task_id - 1, entry_id))
+
+  # Removes the tasks imported from source for rank id_rank and their manifest entries.
+  def remove_ingestions(self, source, id_rank):
+    dbc = self.db.cursor()
+    # A single scan of each marker table (their id column is not indexed) for all the entries of the manifest.
+    for table in ['CUPTI_ACTIVITY_KIND_MARKER', 'CUPTI_ACTIVITY_KIND_MARKER_DATA']:
+      dbc.execute('DELETE FROM "{}" WHERE EXISTS (SELECT 1 FROM "IngestionManifest" m WHERE m.source=? AND m.rank=? '
+                  'AND "{}".id BETWEEN m.firstTaskId AND m.lastTaskId)'.format(table, table), (source, id_rank))
+    dbc.execute('DELETE FROM "IngestionManifest" WHERE source=? AND rank=?', (source, id_rank))
+
   def insert_process(self, rank_id):
     dbc = self.db.cursor()
+    rows = dbc.execute('SELECT _id_ FROM "CUPTI_ACTIVITY_KIND_NAME" WHERE objectKind=1 AND objectId=?', (hex_ProcThreadId(rank_id, 0),)).fetchall()
+    if len(rows) > 0:
+      return
     id_str_rank = self.insert_string("Rank")
     dbc.execute('INSERT INTO "CUPTI_ACTIVITY_KIND_NAME" (objectKind, objectId, name) VALUES(1,?,?)', (hex_ProcThreadId(rank_id, 0), id_str_rank))
 
@@ -58,19 +127,115 @@ class nvprof_db:
     self.insert_task_entry(time_end, 4, task_id_, hex_ProcThreadId(id_rank, tid_end), 0, 0)
     self.task_color(task_id_, task_name, task_group)
 
+  # tasks is an iterable of (task_name, task_group, tid_st, time_st, tid_end, time_end).
+  # The rows are identical to the ones written by insert_task, but they are sent to sqlite
+  # in batches and the marker index is (optionally) rebuilt once at the end.
+  def insert_tasks(self, id_rank, tasks, combined=False, batch_size=100000, defer_index=True):
+    if defer_index:
+      self.drop_marker_index()
+    object_ids = {}
+    markers = []
+    colors = []
+    n_tasks = 0
+    for task_name, task_group, tid_st, time_st, tid_end, time_end in tasks:
+      str_id = self.insert_string(task_name)
+      if combined and tid_st >= 0:
+        task_group_id = self.insert_string("Thread {}".format(tid_st))
+        tid_st = 0
+        tid_end = 0
+      else:
+        task_group_id = self.insert_string(task_group)
+      if tid_st not in object_ids:
+        object_ids[tid_st] = hex_ProcThreadId(id_rank, tid_st)
+      if tid_end not in object_ids:
+        object_ids[tid_end] = hex_ProcThreadId(id_rank, tid_end)
+      task_id_ = self.task_id
+      self.task_id += 1
+      markers.append((2, time_st, task_id_, object_ids[tid_st], str_id, task_group_id))
+      markers.append((4, time_end, task_id_, object_ids[tid_end], 0, 0))
+      color = self.find_color(task_name, task_group)
+      if color is not None:
+        colors.append((task_id_, EMPTY_PAYLOAD, color_id(color)))
+      n_tasks += 1
+      if len(markers) >= 2 * batch_size:
+        self.insert_task_entries(markers, colors)
+        markers = []
+        colors = []
+    self.insert_task_entries(markers, colors)
+    if defer_index:
+      self.create_marker_index()
+    return n_tasks
+
+  # encoded_ranks is an iterable of the results of encode_tasks (for whole ranks or chunks of them).
+  # The local string ids are remapped to StringTable ids and the task ids are assigned
+  # in the order in which the results are received.
+  def insert_ranks(self, encoded_ranks, batch_size=100000, defer_index=True):
+    if defer_index:
+      self.drop_marker_index()
+    n_tasks = 0
+    for id_rank, strings, tasks in encoded_ranks:
+      self.insert_process(id_rank)
+      str_ids = [self.insert_string(string) for string in strings]
+      markers = []
+      colors = []
+      for time_st, object_id_st, name, group, time_end, object_id_end, color in tasks:
+        task_id_ = self.task_id
+        self.task_id += 1
+        markers.append((2, time_st, task_id_, object_id_st, str_ids[name], str_ids[group]))
+        markers.append((4, time_end, task_id_, object_id_end, 0, 0))
+        if color is not None:
+          colors.append((task_id_, EMPTY_PAYLOAD, color))
+        if len(markers) >= 2 * batch_size:
+          self.insert_task_entries(markers, colors)
+          markers = []
+          colors = []
+      self.insert_task_entries(markers, colors)
+      n_tasks += len(tasks)
+    if defer_index:
+      self.create_marker_index()
+    return n_tasks
+
+  # sqlite3 opens a transaction only before DML statements, therefore it is opened explicitly
+  # to roll back the DROP INDEX together with the tasks if the import fails.
+  # Rebuilding the marker index after the import is faster only if the tasks imported are a large
+  # part of the profile (measured: from about half of the tasks already present), otherwise the
+  # index is kept and updated by the inserts.
+  def defer_index(self, n_tasks):
+    dbc = self.db.cursor()
+    n_markers = dbc.execute('SELECT max(_id_) FROM "CUPTI_ACTIVITY_KIND_MARKER"').fetchone()[0]
+    return n_markers is None or 4 * n_tasks >= n_markers
+
+  def drop_marker_index(self):
+    if not self.db.in_transaction:
+      self.db.execute('BEGIN')
+    dbc = self.db.cursor()
+    dbc.execute('DROP INDEX IF EXISTS INDEX_CUPTI_ACTIVITY_KIND_MARKER')
+
+  def create_marker_index(self):
+    dbc = self.db.cursor()
+    dbc.execute(MARKER_INDEX)
+
   def insert_task_entry(self, time_st, entry_kind_id, task_id, tid_st, str_id, task_group_id):
     dbc = self.db.cursor()
     dbc.execute('INSERT INTO "CUPTI_ACTIVITY_KIND_MARKER" (flags, timestamp, id, objectKind, objectId, name, domain) VALUES(?,?,?,2,?,?,?)', (entry_kind_id, time_st, task_id, tid_st, str_id, task_group_id))
 
+  def insert_task_entries(self, markers, colors):
+    dbc = self.db.cursor()
+    dbc.executemany('INSERT INTO "CUPTI_ACTIVITY_KIND_MARKER" (flags, timestamp, id, objectKind, objectId, name, domain) VALUES(?,?,?,2,?,?,?)', markers)
+    dbc.executemany('INSERT INTO "CUPTI_ACTIVITY_KIND_MARKER_DATA" (flags, id, payloadKind, payload, color, category) VALUES(2,?,1,?,?,0);', colors)
+
   def task_color(self, task_id, task_name, task_group):
-    for task in self.task_colors:
-      if task_name[0:len(task)] == task:
-        self.insert_task_color(task_id, self.task_colors[task])
-        return
-    for group in self.task_group_colors:
-      if task_group[0:len(group)] == group:
-        self.insert_task_color(task_id, self.task_group_colors[group])
-        return
+    color = self.find_color(task_name, task_group)
+    if color is not None:
+      self.insert_task_color(task_id, color)
+
+  def find_color(self, task_name, task_group):
+    key = (task_name, task_group)
+    if key in self.colors:
+      return self.colors[key]
+    color = match_color(self.task_colors, self.task_group_colors, task_name, task_group)
+    self.colors[key] = color
+    return color
     #if task_name in self.task_colors:
     #  self.insert_task_color(task_id, self.task_colors[task_name])
     #elif task_group in self.task_group_colors:
@@ -78,27 +243,10 @@ class nvprof_db:
 
   def insert_task_color(self, task_id, color):
     dbc = self.db.cursor()
-    dbc.execute('INSERT INTO "CUPTI_ACTIVITY_KIND_MARKER_DATA" (flags, id, payloadKind, payload, color, category) VALUES(2,?,1,?,?,0);', (task_id, sqlite3.Binary(b'\x00'*8), color_id(color)))
+    dbc.execute('INSERT INTO "CUPTI_ACTIVITY_KIND_MARKER_DATA" (flags, id, payloadKind, payload, color, category) VALUES(2,?,1,?,?,0);', (task_id, EMPTY_PAYLOAD, color_id(color)))
 
   def load_color_from_json(self, filename=''):
-    self.task_colors = {}
-    self.task_group_colors = {}
-    if filename == '':
-      filename = 'task_colors.json'
-    if not os.path.isfile(filename):
-      print("Warning: {} not found.".format(filename), file=sys.stderr)
-      return
-
-    with open(filename) as data_file:
-      data = json.load(data_file)
-      if "task_colors" in data:
-        self.task_colors = data["task_colors"]
-      else:
-        print("Warning: {} do not contain task_color dictionary.".format(filename), file=sys.stderr)
-      if "task_group_colors" in data:
-        self.task_group_colors = data["task_group_colors"]
-      else:
-        print("Warning: {} do not contain task_group_color dictionary.".format(filename), file=sys.stderr)
+    self.task_colors, self.task_group_colors = load_colors(filename)
 
   def create_tables(self):
     dbc = self.db.cursor()
@@ -157,7 +305,7 @@ class nvprof_db:
     dbc.execute('CREATE INDEX INDEX_CUPTI_ACTIVITY_KIND_EVENT ON CUPTI_ACTIVITY_KIND_EVENT(correlationId)')
     dbc.execute('CREATE INDEX INDEX_CUPTI_ACTIVITY_KIND_METRIC ON CUPTI_ACTIVITY_KIND_METRIC(correlationId)')
     dbc.execute('CREATE INDEX INDEX_CUPTI_ACTIVITY_KIND_CONCURRENT_KERNEL ON CUPTI_ACTIVITY_KIND_CONCURRENT_KERNEL(correlationId)')
-    dbc.execute('CREATE INDEX INDEX_CUPTI_ACTIVITY_KIND_MARKER ON CUPTI_ACTIVITY_KIND_MARKER(timestamp)')
+    dbc.execute(MARKER_INDEX)
     dbc.execute('CREATE INDEX INDEX_CUPTI_ACTIVITY_KIND_GLOBAL_ACCESS ON CUPTI_ACTIVITY_KIND_GLOBAL_ACCESS(correlationId)')
     dbc.execute('CREATE INDEX INDEX_CUPTI_ACTIVITY_KIND_BRANCH ON CUPTI_ACTIVITY_KIND_BRANCH(correlationId)')
     dbc.execute('CREATE INDEX INDEX_CUPTI_ACTIVITY_KIND_OVERHEAD ON CUPTI_ACTIVITY_KIND_OVERHEAD(start)')
@@ -182,6 +330,7 @@ class nvprof_db:
     dbc.execute('CREATE INDEX INDEX_CUPTI_ACTIVITY_KIND_INSTANTANEOUS_EVENT_INSTANCE ON CUPTI_ACTIVITY_KIND_INSTANTANEOUS_EVENT_INSTANCE(timestamp)')
     dbc.execute('CREATE INDEX INDEX_CUPTI_ACTIVITY_KIND_INSTANTANEOUS_METRIC ON CUPTI_ACTIVITY_KIND_INSTANTANEOUS_METRIC(timestamp)')
     dbc.execute('CREATE INDEX INDEX_CUPTI_ACTIVITY_KIND_INSTANTANEOUS_METRIC_INSTANCE ON CUPTI_ACTIVITY_KIND_INSTANTANEOUS_METRIC_INSTANCE(timestamp)')
+    self.create_manifest()
 
 
 def hex_ProcThreadId(pid, tid):
@@ -193,3 +342,66 @@ def hex_ProcThreadId(pid, tid):
 
 def color_id(color):
   return int('0xFF'+color, 16)
+
+# Returns the dictionaries task_colors and task_group_colors of the json file filename.
+def load_colors(filename=''):
+  task_colors = {}
+  task_group_colors = {}
+  if filename == '':
+    filename = 'task_colors.json'
+  if not os.path.isfile(filename):
+    print("Warning: {} not found.".format(filename), file=sys.stderr)
+    return task_colors, task_group_colors
+
+  with open(filename) as data_file:
+    data = json.load(data_file)
+    if "task_colors" in data:
+      task_colors = data["task_colors"]
+    else:
+      print("Warning: {} do not contain task_color dictionary.".format(filename), file=sys.stderr)
+    if "task_group_colors" in data:
+      task_group_colors = data["task_group_colors"]
+    else:
+      print("Warning: {} do not contain task_group_color dictionary.".format(filename), file=sys.stderr)
+  return task_colors, task_group_colors
+
+def match_color(task_colors, task_group_colors, task_name, task_group):
+  for task in task_colors:
+    if task_name[0:len(task)] == task:
+      return task_colors[task]
+  for group in task_group_colors:
+    if task_group[0:len(group)] == group:
+      return task_group_colors[group]
+  return None
+
+# Encodes the tasks of a rank without accessing the database, therefore it can run in a worker process.
+# The strings are interned in a rank local table which is remapped to StringTable ids by nvprof_db.insert_ranks.
+def encode_tasks(id_rank, tasks, task_colors, task_group_colors, combined=False):
+  strings = {}
+  object_ids = {}
+  colors = {}
+  encoded = []
+  for task_name, task_group, tid_st, time_st, tid_end, time_end in tasks:
+    key = (task_name, task_group)
+    if key not in colors:
+      color = match_color(task_colors, task_group_colors, task_name, task_group)
+      colors[key] = None if color is None else color_id(color)
+    if combined and tid_st >= 0:
+      group = "Thread {}".format(tid_st)
+      tid_st = 0
+      tid_end = 0
+    else:
+      group = task_group
+    name_id = strings.setdefault(task_name, len(strings))
+    group_id = strings.setdefault(group, len(strings))
+    if tid_st not in object_ids:
+      object_ids[tid_st] = bytes(hex_ProcThreadId(id_rank, tid_st))
+    if tid_end not in object_ids:
+      object_ids[tid_end] = bytes(hex_ProcThreadId(id_rank, tid_end))
+    encoded.append((time_st, object_ids[tid_st], name_id, group_id, time_end, object_ids[tid_end], colors[key]))
+  return id_rank, list(strings), encoded
+
+# Inverse of hex_ProcThreadId.
+def decode_ProcThreadId(object_id):
+  object_id = bytes(object_id)
+  return int.from_bytes(object_id[:4], byteorder='little'), int.from_bytes(object_id[4:12], byteorder='little', signed=True)
@@ -0,0 +1,129 @@
+# Copyright (c) 2017, Raffaele Solcà
+# All rights reserved.
+#
+# See LICENSE.txt for terms of usage.
+
+import sqlite3
+import nvprof_db
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+# Layout of the objectId blobs (see nvprof_db.hex_ProcThreadId).
+OBJECT_ID_FIELDS = [('rank', '<u4'), ('thread', '<i8')]
+
+COLUMNS = ['id', 'rank', 'name', 'group', 'thread_start', 'start', 'thread_end', 'end']
+
+# The end marker of a task is looked up by rowid, since nvprof_db inserts it right after the start marker.
+# The (slow) lookup by id is used only for the markers written by other tools.
+TASKS_QUERY = '''SELECT s.id, s.timestamp, s.objectId, s.name, s.domain,
+  CASE WHEN e._id_ IS NULL THEN (SELECT x.timestamp FROM CUPTI_ACTIVITY_KIND_MARKER x WHERE x.id = s.id AND x.flags = 4) ELSE e.timestamp END,
+  CASE WHEN e._id_ IS NULL THEN (SELECT x.objectId FROM CUPTI_ACTIVITY_KIND_MARKER x WHERE x.id = s.id AND x.flags = 4) ELSE e.objectId END
+FROM CUPTI_ACTIVITY_KIND_MARKER s
+LEFT JOIN CUPTI_ACTIVITY_KIND_MARKER e ON e._id_ = s._id_ + 1 AND e.id = s.id AND e.flags = 4
+WHERE s.flags = 2'''
+
+# Read only access to the tasks of a nvprof profile.
+# The tasks are rebuilt from the start (flags=2) and end (flags=4) markers and are returned
+# in order of start time.
+class nvprof_reader:
+
+  def __init__(self, filename):
+    self.db = sqlite3.connect('file:{}?mode=ro'.format(filename), uri=True)
+    self.string_table = None
+
+  def close(self):
+    self.db.close()
+
+  # Returns the dictionary StringTable id -> string.
+  def strings(self):
+    if self.string_table is None:
+      dbc = self.db.cursor()
+      self.string_table = {str_id: value for str_id, value in dbc.execute('SELECT _id_, value FROM "StringTable"')}
+      self.string_table[0] = ''
+    return self.string_table
+
+  def ranks(self):
+    dbc = self.db.cursor()
+    return sorted({nvprof_db.decode_ProcThreadId(object_id)[0] for object_id, in dbc.execute('SELECT objectId FROM "CUPTI_ACTIVITY_KIND_NAME" WHERE objectKind=1')})
+
+  # Returns the cursor over the tasks whose start timestamp is in [begin, end), which start on the given
+  # rank and thread and whose name starts with name_prefix (None disables a criterion).
+  # Rows: (task id, start, start objectId, name id, group id, end, end objectId)
+  def select(self, begin=None, end=None, rank=None, thread=None, name_prefix=None):
+    query = TASKS_QUERY
+    params = []
+    if begin is not None:
+      query += ' AND s.timestamp >= ?'
+      params.append(begin)
+    if end is not None:
+      query += ' AND s.timestamp < ?'
+      params.append(end)
+    if rank is not None and thread is not None:
+      query += ' AND s.objectId = ?'
+      params.append(nvprof_db.hex_ProcThreadId(rank, thread))
+    elif rank is not None:
+      query += ' AND substr(s.objectId, 1, 4) = ?'
+      params.append(sqlite3.Binary(rank.to_bytes(4, byteorder='little')))
+    elif thread is not None:
+      query += ' AND substr(s.objectId, 5, 8) = ?'
+      params.append(sqlite3.Binary(thread.to_bytes(8, byteorder='little', signed=True)))
+    if name_prefix:
+      # Range query on the unique index of StringTable.
+      query += ' AND s.name IN (SELECT _id_ FROM "StringTable" WHERE value >= ? AND value < ?)'
+      params += [name_prefix, name_prefix[:-1] + chr(ord(name_prefix[-1]) + 1)]
+    query += ' ORDER BY s.timestamp'
+    dbc = self.db.cursor()
+    return dbc.execute(query, params)
+
+  # Generator of the tasks selected (see select) in the format of nvprof_db.insert_task arguments:
+  # (rank, task name, task group, thread id start, start, thread id end, end).
+  # Tasks without end marker are skipped.
+  def tasks(self, begin=None, end=None, rank=None, thread=None, name_prefix=None):
+    strings = self.strings()
+    object_ids = {}
+    for task_id, time_st, object_id_st, name, group, time_end, object_id_end in self.select(begin, end, rank, thread, name_prefix):
+      if time_end is None:
+        continue
+      if object_id_st not in object_ids:
+        object_ids[object_id_st] = nvprof_db.decode_ProcThreadId(object_id_st)
+      if object_id_end not in object_ids:
+        object_ids[object_id_end] = nvprof_db.decode_ProcThreadId(object_id_end)
+      id_rank, tid_st = object_ids[object_id_st]
+      tid_end = object_ids[object_id_end][1]
+      yield id_rank, strings[name], strings[group], tid_st, time_st, tid_end, time_end
+
+  # Generator of the tasks selected (see select) as dictionaries of numpy arrays of at most chunk_size elements.
+  # Columns: id, rank, name, group (StringTable ids, see strings), thread_start, start, thread_end, end.
+  def iter_arrays(self, begin=None, end=None, rank=None, thread=None, name_prefix=None, chunk_size=1000000):
+    if np is None:
+      raise ImportError('numpy is required for the columnar export')
+    object_id_dtype = np.dtype(OBJECT_ID_FIELDS)
+    cursor = self.select(begin, end, rank, thread, name_prefix)
+    while True:
+      rows = cursor.fetchmany(chunk_size)
+      if len(rows) == 0:
+        return
+      rows = [row for row in rows if row[5] is not None]
+      if len(rows) == 0:
+        continue
+      task_id, time_st, object_id_st, name, group, time_end, object_id_end = zip(*rows)
+      object_st = np.frombuffer(b''.join(object_id_st), dtype=object_id_dtype)
+      object_end = np.frombuffer(b''.join(object_id_end), dtype=object_id_dtype)
+      yield {'id': np.array(task_id, dtype=np.int64),
+             'rank': object_st['rank'].astype(np.int64),
+             'name': np.array(name, dtype=np.int64),
+             'group': np.array(group, dtype=np.int64),
+             'thread_start': object_st['thread'].astype(np.int64),
+             'start': np.array(time_st, dtype=np.int64),
+             'thread_end': object_end['thread'].astype(np.int64),
+             'end': np.array(time_end, dtype=np.int64)}
+
+  # Returns all the tasks selected (see select) as a dictionary of numpy arrays (see iter_arrays).
+  def to_numpy(self, begin=None, end=None, rank=None, thread=None, name_prefix=None, chunk_size=1000000):
+    chunks = list(self.iter_arrays(begin, end, rank, thread, name_prefix, chunk_size))
+    if len(chunks) == 0:
+      return {column: np.zeros(0, dtype=np.int64) for column in COLUMNS}
+    return {column: np.concatenate([chunk[column] for chunk in chunks]) for column in COLUMNS}
@@ -3,47 +3,193 @@
 #
 # See LICENSE.txt for terms of usage.
 
-import csv
+import os
 import sys
+import glob
+import json
+import itertools
+import collections
+import multiprocessing
 import nvprof_db
+import chrome_trace
+import task_csv
+import task_filter
 import argparse
 
-parser = argparse.ArgumentParser(description='Insert the data of a csv profile in a nvprof profile')
-parser.add_argument('filename', help='name of the csv profile (input file)')
-parser.add_argument('--output', '-o', help='The name of the nvprof profile to be created or modified (Default: filename with extension changed to ".nvprof")')
+parser = argparse.ArgumentParser(description='Insert the data of a csv profile in a nvprof profile (or write it as a Chrome trace)')
+parser.add_argument('filename', nargs='*', help='name of the csv or binary profile (input file). If more than one file (or a glob pattern) is given the files are imported in parallel, and the rank ids are assigned in sorted filename order starting from RANK.')
+parser.add_argument('--output', '-o', help='The name of the nvprof profile to be created or modified (Default: filename with extension changed to ".nvprof" (".json" for chrome format), required with multiple input files)')
+parser.add_argument('--format', '-F', choices=['nvprof', 'chrome'], default='nvprof', help='Output format: nvprof profile or Chrome trace event json (for chrome://tracing and Perfetto). The chrome output is always overwritten and does not support --follow. (Default: nvprof)')
 parser.add_argument('--rank', '-r', type=int, default=0, help='MPI rank number (default: 0)')
+parser.add_argument('--rank-map', '-m', help='json file containing a dictionary rank -> csv profile filename. The files are imported in parallel.')
+parser.add_argument('--jobs', '-j', type=int, default=None, help='Number of processes used to parse the csv profiles in multi-file mode (Default: number of cores)')
 parser.add_argument('--color-dict-filename', '-c', default="./task_color.json", help='the json file containing the dictionaries "task_colors" and "task_group_colors" (Default: ./task_color.json). If this file doeas not exist a warning message is displayed and the default color is used for all the tasks.')
+parser.add_argument('--follow', '-f', action='store_true', help='Follow the profile while it is written by a Profiler with a flush policy, and insert the new tasks as they are written.')
+parser.add_argument('--poll-interval', type=float, default=1., help='Time in seconds between two checks of the followed profile (Default: 1)')
+parser.add_argument('--follow-timeout', type=float, default=None, help='Stop following the profile if no task is written for FOLLOW_TIMEOUT seconds (Default: follow until interrupted)')
+parser.add_argument('--begin', type=int, default=None, help='Import only the tasks ending after BEGIN (timestamp in nanoseconds)')
+parser.add_argument('--end', type=int, default=None, help='Import only the tasks starting before END (timestamp in nanoseconds)')
+parser.add_argument('--aggregate', '-a', type=int, default=None, help='Merge the runs of consecutive tasks shorter than AGGREGATE nanoseconds of each thread in a single task named with their number and total time (Default: no aggregation)')
+parser.add_argument('--aggregate-gap', type=int, default=None, help='Maximum idle time in nanoseconds between two tasks of an aggregated run (Default: AGGREGATE)')
 parser.add_argument('--combine-threads', '-C', type=bool, default=False, help='Combine threads in the profile to have a better view')
 args = parser.parse_args()
 
-filename = args.filename
 rank_id = args.rank
+task_filters = {'begin': args.begin, 'end': args.end, 'min_duration': args.aggregate, 'max_gap': args.aggregate_gap}
 color_filename = args.color_dict_filename
 combined = args.combine_threads
+# The options changing the imported tasks, recorded in the ingestion manifest (empty for a plain import).
+import_options = {option: value for option, value in task_filters.items() if value != None}
+if combined:
+  import_options['combine_threads'] = True
+import_options = json.dumps(import_options, sort_keys=True) if len(import_options) > 0 else ''
+
+rank_files = []
+if args.rank_map != None:
+  with open(args.rank_map) as map_file:
+    rank_files = sorted((int(rank), filename) for rank, filename in json.load(map_file).items())
+filenames = []
+for pattern in args.filename:
+  matches = sorted(glob.glob(pattern))
+  if len(matches) == 0:
+    matches = [pattern]
+  filenames += matches
+rank_files += [(rank_id + i, filename) for i, filename in enumerate(filenames)]
+if len(rank_files) == 0:
+  parser.error('no input file given')
+multi_file = len(rank_files) > 1 or args.rank_map != None
+if multi_file and args.follow:
+  parser.error('--follow supports a single input file')
+if args.format == 'chrome' and args.follow:
+  parser.error('--follow is not supported with the chrome format')
+output_extension = '.json' if args.format == 'chrome' else '.nvprof'
+
 if args.output == None:
+  if multi_file:
+    parser.error('--output is required with multiple input files')
+  filename = rank_files[0][1]
   i = filename.rfind('.')
   if i == -1:
-    output_filename = filename + '.nvprof'
+    output_filename = filename + output_extension
   else:
-    output_filename = filename[:i] + '.nvprof'
+    output_filename = filename[:i] + output_extension
 else:
   output_filename = args.output
 
-print(filename, rank_id, color_filename, output_filename)
+# Returns the offset from which filename has to be imported for rank_id according to the ingestion manifest:
+# the end of the data already imported if the file was only appended since and it was imported with the same
+# options, otherwise the beginning of the data (in this case the tasks previously imported from the file are removed).
+def resume_offset(prof_db, source, filename, rank_id):
+  start = task_csv.data_start(filename)
+  ingestion = prof_db.last_ingestion(source, rank_id)
+  if ingestion == None:
+    return start
+  end, fingerprint, options = ingestion
+  if options != import_options:
+    print("Warning: {} was imported with different options ({}), its tasks are imported again.".format(filename, options if options != '' else 'none'), file=sys.stderr)
+  elif os.path.getsize(filename) >= end and task_csv.fingerprint(filename, end) == fingerprint:
+    if os.path.getsize(filename) == end or task_csv.task_start(filename, end):
+      return end
+    # The last line was imported without newline: it is complete if a newline follows,
+    # otherwise it may have been extended since and the file is imported again.
+    if task_csv.task_start(filename, end + 1):
+      return end + 1
+    print("Warning: the last task imported from {} changed, its tasks are imported again.".format(filename), file=sys.stderr)
+  else:
+    print("Warning: {} changed since it was imported, its tasks are imported again.".format(filename), file=sys.stderr)
+  prof_db.remove_ingestions(source, rank_id)
+  return start
 
-prof_db = nvprof_db.nvprof_db(output_filename, color_filename)
+# Same as pool.imap(function, jobs), but at most window results are computed in advance,
+# to bound the memory used if the results are consumed more slowly than they are computed.
+def imap_bounded(pool, function, jobs, window):
+  pending = collections.deque()
+  for job in jobs:
+    if len(pending) >= window:
+      yield pending.popleft().get()
+    pending.append(pool.apply_async(function, (job,)))
+  while len(pending) > 0:
+    yield pending.popleft().get()
 
-prof_db.insert_process(rank_id)
+if __name__ == '__main__' and args.format == 'chrome':
+  # The files are streamed one after the other, the threads are displayed separately in any case.
+  trace = chrome_trace.chrome_trace(output_filename, color_filename, combined=combined)
+  for rank_id, filename in rank_files:
+    print(filename, rank_id, color_filename, output_filename)
+    trace.insert_process(rank_id)
+    trace.insert_tasks(rank_id, task_filter.filter_tasks(task_csv.read_file(filename), **task_filters))
+  trace.close()
 
-with open(filename) as csvfile:
-  tasks = csv.reader(csvfile, delimiter=',')
-  for task in tasks:
-    task_name = task[0].strip()
-    task_group = task[1].strip()
-    tid_st = int(task[2].strip())
-    time_st = int(task[3].strip())
-    tid_en = int(task[4].strip())
-    time_en = int(task[5].strip())
-    prof_db.insert_task(rank_id, task_name, task_group, tid_st, time_st, tid_en, time_en, combined=combined)
+elif __name__ == '__main__':
+  prof_db = nvprof_db.nvprof_db(output_filename, color_filename)
+
+  if multi_file:
+    # The profiles are split in chunks which are parsed by the workers and written in order as they are
+    # received, therefore the memory used does not depend on the size of the ranks.
+    ranks = []
+    jobs = []
+    for rank_id, filename in rank_files:
+      print(filename, rank_id, color_filename, output_filename)
+      source = os.path.realpath(filename)
+      start = resume_offset(prof_db, source, filename, rank_id)
+      end = task_csv.import_size(filename)
+      if start >= end:
+        print("{} already imported".format(filename))
+        continue
+      chunks = task_csv.split_range(filename, start, end)
+      ranks.append((rank_id, filename, start, end, len(chunks)))
+      jobs += [(rank_id, filename, chunk_start, chunk_end, prof_db.task_colors, prof_db.task_group_colors, combined, task_filters)
+               for chunk_start, chunk_end in chunks]
+    defer_index = prof_db.defer_index(sum(task_csv.estimate_tasks(rank[1], rank[2], rank[3]) for rank in ranks))
+    if defer_index:
+      prof_db.drop_marker_index()
+    n_processes = args.jobs if args.jobs != None else os.cpu_count()
+    with multiprocessing.Pool(n_processes) as pool:
+      encoded_chunks = imap_bounded(pool, task_csv.encode_file, jobs, 2 * n_processes)
+      for rank_id, filename, start, end, n_chunks in ranks:
+        first_task_id = prof_db.task_id
+        prof_db.insert_ranks(itertools.islice(encoded_chunks, n_chunks), defer_index=False)
+        prof_db.record_ingestion(os.path.realpath(filename), rank_id, start, end, task_csv.fingerprint(filename, end), first_task_id, import_options)
+    if defer_index:
+      prof_db.create_marker_index()
+  else:
+    rank_id, filename = rank_files[0]
+    print(filename, rank_id, color_filename, output_filename)
+    source = os.path.realpath(filename)
+    prof_db.insert_process(rank_id)
+    if args.follow:
+      offset = None
+      if os.path.isfile(filename):
+        offset = resume_offset(prof_db, source, filename, rank_id)
+      entry_id = None
+      try:
+        # The tasks are committed after each update, the index is kept to avoid rebuilding it every time.
+        for tasks, end, restarted in task_csv.follow_file(filename, offset, args.poll_interval, args.follow_timeout):
+          if restarted:
+            print("Warning: {} was rewritten, its tasks are imported again.".format(filename), file=sys.stderr)
+            prof_db.remove_ingestions(source, rank_id)
+            entry_id = None
+            offset = None
+          first_task_id = prof_db.task_id
+          prof_db.insert_tasks(rank_id, task_filter.filter_tasks(tasks, **task_filters), combined=combined, defer_index=False)
+          if entry_id == None:
+            start = task_csv.data_start(filename) if offset == None else offset
+            entry_id = prof_db.record_ingestion(source, rank_id, start, end, task_csv.fingerprint(filename, end), first_task_id, import_options)
+          else:
+            prof_db.update_ingestion(entry_id, end, task_csv.fingerprint(filename, end))
+          prof_db.commit()
+      except KeyboardInterrupt:
+        prof_db.rollback()
+    else:
+      start = resume_offset(prof_db, source, filename, rank_id)
+      end = task_csv.import_size(filename)
+      if start < end:
+        first_task_id = prof_db.task_id
+        tasks = task_filter.filter_tasks(task_csv.read_file(filename, start, end), **task_filters)
+        defer_index = prof_db.defer_index(task_csv.estimate_tasks(filename, start, end))
+        prof_db.insert_tasks(rank_id, tasks, combined=combined, defer_index=defer_index)
+        prof_db.record_ingestion(source, rank_id, start, end, task_csv.fingerprint(filename, end), first_task_id, import_options)
+      else:
+        print("{} already imported".format(filename))
 
-prof_db.commit()
+  prof_db.commit()
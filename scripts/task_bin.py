@@ -0,0 +1,111 @@
+# Copyright (c) 2017, Raffaele Solcà
+# All rights reserved.
+#
+# See LICENSE.txt for terms of usage.
+
+# Reader of the binary profiles written by profiler::Profiler with OutputFormat::binary.
+# The file contains a 16 bytes header (magic, version, record size) followed by fixed size records.
+# The task and group names are stored in <filename>.strings, one per line.
+
+import os
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+MAGIC = b'PROFBIN1'
+VERSION = 1
+HEADER_SIZE = 16
+
+RECORD_FIELDS = [('time_start', '<u8'), ('time_end', '<u8'), ('task_name_id', '<u4'), ('task_group_id', '<u4'),
+                 ('thread_id_start', '<i4'), ('thread_id_end', '<i4')]
+RECORD_SIZE = 32
+
+def is_binary_profile(filename):
+  with open(filename, 'rb') as profile_file:
+    return profile_file.read(len(MAGIC)) == MAGIC
+
+def load_strings(filename):
+  with open(filename + '.strings') as strings_file:
+    return [line[:-1] for line in strings_file]
+
+# Appends the complete lines of <filename>.strings after offset to strings and returns the new offset.
+def read_new_strings(filename, offset, strings):
+  strings_filename = filename + '.strings'
+  if not os.path.isfile(strings_filename):
+    return offset
+  with open(strings_filename, 'rb') as strings_file:
+    strings_file.seek(offset)
+    data = strings_file.read()
+  end = data.rfind(b'\n') + 1
+  strings += data[:end].decode().split('\n')[:-1]
+  return offset + end
+
+def check_header(filename):
+  record_dtype = np.dtype(RECORD_FIELDS)
+  with open(filename, 'rb') as profile_file:
+    header = profile_file.read(HEADER_SIZE)
+  if header[:len(MAGIC)] != MAGIC:
+    raise ValueError('{} is not a binary profile'.format(filename))
+  version = int.from_bytes(header[8:12], byteorder='little')
+  record_size = int.from_bytes(header[12:16], byteorder='little')
+  if version != VERSION or record_size != record_dtype.itemsize:
+    raise ValueError('{}: unsupported binary profile version {} (record size {})'.format(filename, version, record_size))
+  return record_dtype
+
+# Returns the size of the header and of the complete records.
+def complete_size(filename):
+  size = os.path.getsize(filename)
+  if size < HEADER_SIZE:
+    return 0
+  record_size = np.dtype(RECORD_FIELDS).itemsize
+  return HEADER_SIZE + (size - HEADER_SIZE) // record_size * record_size
+
+# Returns the records as a memory mapped numpy structured array and the list of strings.
+def load(filename):
+  if np is None:
+    raise ImportError('numpy is required to read binary profiles')
+  record_dtype = check_header(filename)
+  records = np.memmap(filename, dtype=record_dtype, mode='r', offset=HEADER_SIZE)
+  return records, load_strings(filename)
+
+def records_to_tasks(records, strings):
+  for time_st, time_en, name_id, group_id, tid_st, tid_en in records.tolist():
+    yield strings[name_id], strings[group_id], tid_st, time_st, tid_en, time_en
+
+# Yields the tasks in the same format as task_csv.read_tasks.
+# start and end are byte offsets in the file (Default: all the records).
+def read_tasks(filename, start=HEADER_SIZE, end=None, chunk_size=1000000):
+  records, strings = load(filename)
+  record_size = records.dtype.itemsize
+  if end is None:
+    end = HEADER_SIZE + len(records) * record_size
+  records = records[(start - HEADER_SIZE) // record_size:(end - HEADER_SIZE) // record_size]
+  for i in range(0, len(records), chunk_size):
+    yield from records_to_tasks(records[i:i + chunk_size], strings)
+
+# Generator following a binary profile which is being written by a Profiler with a flush policy.
+# Every iteration returns the list of the tasks appended since the previous one (possibly empty)
+# and the offset of the end of the records read.
+# Only the records whose strings are already available are returned.
+def follow_tasks(filename, offset=HEADER_SIZE, max_records=1000000):
+  if np is None:
+    raise ImportError('numpy is required to read binary profiles')
+  while os.path.getsize(filename) < HEADER_SIZE:
+    yield [], offset
+  record_dtype = check_header(filename)
+  strings = []
+  strings_offset = 0
+  while True:
+    strings_offset = read_new_strings(filename, strings_offset, strings)
+    n = min((os.path.getsize(filename) - offset) // record_dtype.itemsize, max_records)
+    if n == 0:
+      yield [], offset
+      continue
+    records = np.fromfile(filename, dtype=record_dtype, count=n, offset=offset)
+    missing = np.flatnonzero(np.maximum(records['task_name_id'], records['task_group_id']) >= len(strings))
+    if len(missing) > 0:
+      records = records[:missing[0]]
+    offset += len(records) * record_dtype.itemsize
+    yield list(records_to_tasks(records, strings)), offset
@@ -0,0 +1,203 @@
+# Copyright (c) 2017, Raffaele Solcà
+# All rights reserved.
+#
+# See LICENSE.txt for terms of usage.
+
+import csv
+import hashlib
+import os
+import sys
+import time
+import nvprof_db
+import task_bin
+import task_filter
+
+def read_tasks(csvfile):
+  tasks = csv.reader(csvfile, delimiter=',')
+  for task in tasks:
+    task_name = task[0].strip()
+    task_group = task[1].strip()
+    tid_st = int(task[2])
+    time_st = int(task[3])
+    tid_en = int(task[4])
+    time_en = int(task[5])
+    yield task_name, task_group, tid_st, time_st, tid_en, time_en
+
+BLOCK_SIZE = 65536
+
+# Yields the lines between the byte offsets start and end.
+def read_lines(filename, start=0, end=None):
+  with open(filename, 'rb') as csvfile:
+    csvfile.seek(start)
+    for line in csvfile:
+      start += len(line)
+      if end is not None and start > end:
+        return
+      yield line.decode()
+
+# Reads a csv profile or a binary profile (see task_bin.py).
+# start and end are byte offsets in the file (Default: the whole file).
+def read_file(filename, start=None, end=None):
+  if task_bin.is_binary_profile(filename):
+    yield from task_bin.read_tasks(filename, task_bin.HEADER_SIZE if start is None else start, end)
+  elif start is None and end is None:
+    with open(filename) as csvfile:
+      yield from read_tasks(csvfile)
+  else:
+    yield from read_tasks(read_lines(filename, start, end))
+
+# Offset of the first task in the profile.
+def data_start(filename):
+  if task_bin.is_binary_profile(filename):
+    return task_bin.HEADER_SIZE
+  return 0
+
+# Offset of the end of the last complete task in the profile.
+def complete_size(filename):
+  if task_bin.is_binary_profile(filename):
+    return task_bin.complete_size(filename)
+  with open(filename, 'rb') as csvfile:
+    end = csvfile.seek(0, os.SEEK_END)
+    while end > 0:
+      block = min(end, BLOCK_SIZE)
+      csvfile.seek(end - block)
+      i = csvfile.read(block).rfind(b'\n')
+      if i >= 0:
+        return end - block + i + 1
+      end -= block
+  return 0
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Splits the byte range [start, end) of a profile in ranges of about chunk_size bytes
+# which contain complete tasks (used to parse a large profile in parallel).
+def split_range(filename, start, end, chunk_size=CHUNK_SIZE):
+  if task_bin.is_binary_profile(filename):
+    record_size = task_bin.RECORD_SIZE
+    chunk_size = max(1, chunk_size // record_size) * record_size
+    return [(offset, min(offset + chunk_size, end)) for offset in range(start, end, chunk_size)]
+  ranges = []
+  with open(filename, 'rb') as csvfile:
+    while start < end:
+      chunk_end = start + chunk_size
+      if chunk_end < end:
+        csvfile.seek(chunk_end)
+        chunk_end += len(csvfile.readline())
+      chunk_end = min(chunk_end, end)
+      ranges.append((start, chunk_end))
+      start = chunk_end
+  return ranges
+
+# Estimated number of tasks between the offsets start and end (exact for binary profiles),
+# from the average length of the lines of the first block.
+def estimate_tasks(filename, start, end):
+  if task_bin.is_binary_profile(filename):
+    return (end - start) // task_bin.RECORD_SIZE
+  with open(filename, 'rb') as csvfile:
+    csvfile.seek(start)
+    block = csvfile.read(min(end - start, BLOCK_SIZE))
+  n_lines = block.count(b'\n')
+  if n_lines == 0:
+    return 0
+  return (end - start) * n_lines // len(block)
+
+# Offset of the end of the tasks to import from a finished profile: the end of the file if its last line
+# (without newline) is a complete task, otherwise the end of the last complete task (with a warning).
+def import_size(filename):
+  end = complete_size(filename)
+  size = os.path.getsize(filename)
+  if end == size:
+    return end
+  if not task_bin.is_binary_profile(filename):
+    with open(filename, 'rb') as csvfile:
+      csvfile.seek(end)
+      rest = csvfile.read()
+    if len(rest.strip()) == 0:
+      return end
+    try:
+      list(read_tasks([rest.decode()]))
+      return size
+    except (ValueError, IndexError, UnicodeDecodeError):
+      pass
+  print("Warning: the last {} bytes of {} are not a complete task and are not imported.".format(size - end, filename), file=sys.stderr)
+  return end
+
+# True if a task starts at offset (the offsets of binary profiles are always at a record boundary).
+def task_start(filename, offset):
+  if offset == data_start(filename) or task_bin.is_binary_profile(filename):
+    return True
+  with open(filename, 'rb') as csvfile:
+    csvfile.seek(offset - 1)
+    return csvfile.read(1) == b'\n'
+
+# Fingerprint of the first end bytes of the profile (length, first and last block),
+# used to detect if a profile was only appended since it was imported.
+def fingerprint(filename, end):
+  fingerprint = hashlib.sha1(str(end).encode())
+  with open(filename, 'rb') as profile_file:
+    fingerprint.update(profile_file.read(min(end, BLOCK_SIZE)))
+    last_block = max(BLOCK_SIZE, end - BLOCK_SIZE)
+    if end > last_block:
+      profile_file.seek(last_block)
+      fingerprint.update(profile_file.read(end - last_block))
+  return fingerprint.hexdigest()
+
+# Generator following a csv profile which is being written by a Profiler with a flush policy.
+# Every iteration returns the list of the tasks appended since the previous one (possibly empty)
+# and the offset of the end of the lines read.
+# The last line is parsed only once it is complete.
+def follow_tasks(filename, offset=0, max_bytes=64*1024*1024):
+  while True:
+    with open(filename, 'rb') as csvfile:
+      csvfile.seek(offset)
+      data = csvfile.read(max_bytes)
+    end = data.rfind(b'\n') + 1
+    offset += end
+    yield list(read_tasks(data[:end].decode().splitlines())), offset
+
+# True if the first offset bytes of the profile are not the ones whose fingerprint is prefix,
+# i.e. the profile was truncated or rewritten (e.g. by a new run of the application).
+def rewritten(filename, offset, prefix):
+  return not os.path.isfile(filename) or os.path.getsize(filename) < offset or fingerprint(filename, offset) != prefix
+
+# Follows a csv or binary profile (see follow_tasks) from offset (Default: the beginning) until no new task
+# is written for timeout seconds (forever if timeout is None). Yields the non empty lists of new tasks,
+# the offset of the end of the data read, and whether the profile was rewritten since the previous tasks
+# (in this case the tasks are read again from the beginning of the new profile).
+def follow_file(filename, offset=None, poll_interval=1., timeout=None):
+  last_update = time.time()
+  restarted = False
+  while True:
+    while not os.path.isfile(filename) or os.path.getsize(filename) < len(task_bin.MAGIC):
+      if timeout is not None and time.time() - last_update > timeout:
+        return
+      time.sleep(poll_interval)
+    if offset is None:
+      offset = data_start(filename)
+    if task_bin.is_binary_profile(filename):
+      follower = task_bin.follow_tasks(filename, offset)
+    else:
+      follower = follow_tasks(filename, offset)
+    # The data already read is checked before every read, never to parse from the middle of a line.
+    prefix = fingerprint(filename, offset)
+    while not rewritten(filename, offset, prefix):
+      tasks, offset = next(follower)
+      if len(tasks) > 0:
+        last_update = time.time()
+        prefix = fingerprint(filename, offset)
+        yield tasks, offset, restarted
+        restarted = False
+        continue
+      if timeout is not None and time.time() - last_update > timeout:
+        return
+      time.sleep(poll_interval)
+    restarted = True
+    offset = None
+
+# Worker of the multi-file import (see prof.py), which encodes the tasks of a chunk of a profile.
+# job is (rank_id, filename, start, end, task_colors, task_group_colors, combined, task_filters)
+# where task_filters are the arguments of task_filter.filter_tasks.
+def encode_file(job):
+  rank_id, filename, start, end, task_colors, task_group_colors, combined, task_filters = job
+  tasks = task_filter.filter_tasks(read_file(filename, start, end), **task_filters)
+  return nvprof_db.encode_tasks(rank_id, tasks, task_colors, task_group_colors, combined)
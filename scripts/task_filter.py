@@ -0,0 +1,64 @@
+# Copyright (c) 2017, Raffaele Solcà
+# All rights reserved.
+#
+# See LICENSE.txt for terms of usage.
+
+# Filters applied to the tasks (task_name, task_group, tid_st, time_st, tid_end, time_end) before the import.
+
+# Keeps the tasks which overlap the time window [begin, end) (None disables the bound).
+def time_window(tasks, begin=None, end=None):
+  for task in tasks:
+    if (begin is None or task[5] > begin) and (end is None or task[3] < end):
+      yield task
+
+def summary_task(run):
+  task_name, task_group, tid_st, time_st, tid_end, time_end, count, total = run
+  if count == 1:
+    return task_name, task_group, tid_st, time_st, tid_end, time_end
+  if task_name is None:
+    task_name = "{} tasks ({:.1f} us)".format(count, total / 1e3)
+  else:
+    task_name = "{} x{} ({:.1f} us)".format(task_name, count, total / 1e3)
+  if task_group is None:
+    task_group = "Aggregated"
+  return task_name, task_group, tid_st, time_st, tid_end, time_end
+
+# Merges the runs of consecutive tasks shorter than min_duration of each thread (the thread where the tasks start)
+# in a single task named with the number of tasks and their total time. A run is interrupted by a longer task
+# or by an idle time longer than max_gap (Default: min_duration).
+def aggregate_tasks(tasks, min_duration, max_gap=None):
+  if max_gap is None:
+    max_gap = min_duration
+  # tid_st -> [task_name, task_group, tid_st, time_st, tid_end, time_end, count, total]
+  runs = {}
+  for task in tasks:
+    task_name, task_group, tid_st, time_st, tid_end, time_end = task
+    duration = time_end - time_st
+    run = runs.get(tid_st)
+    if run is not None and (duration >= min_duration or time_st - run[5] > max_gap):
+      yield summary_task(run)
+      del runs[tid_st]
+      run = None
+    if duration >= min_duration:
+      yield task
+    elif run is None:
+      runs[tid_st] = [task_name, task_group, tid_st, time_st, tid_end, time_end, 1, duration]
+    else:
+      if run[0] != task_name:
+        run[0] = None
+      if run[1] != task_group:
+        run[1] = None
+      run[3] = min(run[3], time_st)
+      run[4] = tid_end
+      run[5] = max(run[5], time_end)
+      run[6] += 1
+      run[7] += duration
+  for run in runs.values():
+    yield summary_task(run)
+
+def filter_tasks(tasks, begin=None, end=None, min_duration=None, max_gap=None):
+  if begin is not None or end is not None:
+    tasks = time_window(tasks, begin, end)
+  if min_duration is not None:
+    tasks = aggregate_tasks(tasks, min_duration, max_gap)
+  return tasks